@@ -4,6 +4,7 @@ import uuid
 from datetime import datetime
 import json
 import os
+from storage import ShardedStorage, TimestampIndex
 
 # Page configuration
 st.set_page_config(
@@ -13,45 +14,49 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Simple storage class
+# Simple storage class backed by one file per chat and a title manifest
 class ChatStorage:
     def __init__(self):
         self.file = "chats.json"
+        self.store = ShardedStorage(path="chats", legacy_path=None, manifest_fields=("title", "created"))
+        self.index = None
+        self.index_signature = None
         self.init_file()
     
     def init_file(self):
-        if not os.path.exists(self.file):
-            with open(self.file, 'w') as f:
-                json.dump({}, f)
+        # Move chats from the old single-file layout into shards once; renaming the
+        # old file afterwards keeps deleted chats from being imported again
+        if os.path.exists(self.file):
+            try:
+                with open(self.file, 'r') as f:
+                    data = json.load(f)
+                if not self.store.read_manifest():
+                    for cid, cdata in data.items():
+                        self.store.put(cid, cdata)
+                os.replace(self.file, self.file + ".migrated")
+            except:
+                pass
     
     def save_chat(self, chat_id, messages, title):
         try:
-            with open(self.file, 'r') as f:
-                data = json.load(f)
-            data[chat_id] = {
+            self.store.put(chat_id, {
                 "title": title,
                 "messages": messages,
                 "created": datetime.now().isoformat()
-            }
-            with open(self.file, 'w') as f:
-                json.dump(data, f)
+            })
         except:
             pass
     
     def load_chat(self, chat_id):
         try:
-            with open(self.file, 'r') as f:
-                data = json.load(f)
-            return data.get(chat_id, {}).get("messages", [])
+            return (self.store.get(chat_id) or {}).get("messages", [])
         except:
             return []
     
     def get_chats(self):
         try:
-            with open(self.file, 'r') as f:
-                data = json.load(f)
             chats = []
-            for cid, cdata in data.items():
+            for cid, cdata in self.store.read_manifest().items():
                 chats.append({
                     "id": cid,
                     "title": cdata.get("title", "New chat"),
@@ -62,14 +67,20 @@ class ChatStorage:
         except:
             return []
     
+    def list_chats(self, limit=20, before_created=None, before_id=None):
+        """One page of chats, newest first, from an index rebuilt only when the manifest changes"""
+        try:
+            signature = self.store.signature()
+            if self.index is None or signature != self.index_signature:
+                self.index = TimestampIndex(self.get_chats(), key="created", id_key="id")
+                self.index_signature = signature
+            return self.index.page(limit, before_created, before_id)
+        except:
+            return []
+    
     def delete_chat(self, chat_id):
         try:
-            with open(self.file, 'r') as f:
-                data = json.load(f)
-            if chat_id in data:
-                del data[chat_id]
-                with open(self.file, 'w') as f:
-                    json.dump(data, f)
+            self.store.delete(chat_id)
         except:
             pass
 
@@ -82,6 +93,8 @@ if 'chat_id' not in st.session_state:
     st.session_state.chat_id = str(uuid.uuid4())
 if 'title' not in st.session_state:
     st.session_state.title = "New chat"
+if 'history_pages' not in st.session_state:
+    st.session_state.history_pages = 1
 
 # ChatGPT-like CSS
 st.markdown("""
@@ -375,9 +388,16 @@ with st.sidebar:
     
     # Chat history
     st.markdown('<div class="chat-history">', unsafe_allow_html=True)
-    chats = st.session_state.storage.get_chats()
+    chats = []
+    before = ()
+    for _ in range(st.session_state.history_pages):
+        page = st.session_state.storage.list_chats(20, *before)
+        chats.extend(page)
+        if len(page) < 20:
+            break
+        before = (page[-1]["created"], page[-1]["id"])
     
-    for chat in chats[:20]:
+    for chat in chats:
         title = chat["title"][:25] + "..." if len(chat["title"]) > 25 else chat["title"]
         
         col1, col2 = st.columns([5, 1])
@@ -390,6 +410,11 @@ with st.sidebar:
                 st.session_state.storage.delete_chat(chat["id"])
                 st.rerun()
     
+    if len(chats) >= 20 * st.session_state.history_pages:
+        if st.button("Load more", key="load_more", use_container_width=True):
+            st.session_state.history_pages += 1
+            st.rerun()
+    
     st.markdown('</div>', unsafe_allow_html=True)
     st.markdown('</div>', unsafe_allow_html=True)
 
@@ -1,11 +1,14 @@
 import streamlit as st
 import google.generativeai as genai
-import chromadb
+import os
 import uuid
 from datetime import datetime, timedelta
 import json
-from chat_history import ChatHistoryManager
+from chat_history import ChatHistoryManager, SaveCoordinator
 from utils import AIResponseHandler, ChatUtils, ExportManager, AdvancedSearch, get_response_stats
+from search_index import MetadataTable
+from embeddings import default_embedder
+from vector_index import ChromaChunkStore, QuantizedVectorIndex
 
 # Page configuration
 st.set_page_config(
@@ -15,10 +18,23 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+REFERENCE_CORPUS_DIR = "reference_corpus"
+
 # Initialize chat history manager
 @st.cache_resource
 def init_chat_manager():
-    return ChatHistoryManager()
+    manager = ChatHistoryManager(backend="sqlite", cache=True, write_behind=True, substring_index=True)
+    # Message-level chunks in the local int8 vector index, kept in step with saves and deletes
+    embedder = default_embedder()
+    chunks = ChromaChunkStore(QuantizedVectorIndex(f"{manager.history_file}.chunks", dim=embedder.dim), embedder)
+    if not chunks.collection.count():
+        chunks.ingest((chat_id, conv_data.get('messages', []), {"timestamp": conv_data.get('timestamp', '')})
+                      for chat_id, conv_data in manager.storage.conversations())
+    manager.attach_index("chunks", chunks)
+    # Optional local texts that rewrites are also checked against
+    if os.path.isdir(REFERENCE_CORPUS_DIR):
+        manager.add_reference_corpus(REFERENCE_CORPUS_DIR)
+    return manager
 
 # Initialize session state
 if 'messages' not in st.session_state:
@@ -27,12 +43,18 @@ if 'chat_id' not in st.session_state:
     st.session_state.chat_id = str(uuid.uuid4())
 if 'chat_manager' not in st.session_state:
     st.session_state.chat_manager = init_chat_manager()
+if 'save_coordinator' not in st.session_state:
+    st.session_state.save_coordinator = SaveCoordinator(st.session_state.chat_manager)
 if 'current_chat_title' not in st.session_state:
     st.session_state.current_chat_title = "New Chat"
 if 'show_stats' not in st.session_state:
     st.session_state.show_stats = False
 if 'dark_mode' not in st.session_state:
     st.session_state.dark_mode = True
+if 'history_pages' not in st.session_state:
+    st.session_state.history_pages = 1
+
+HISTORY_PAGE_SIZE = 20
 
 # Custom CSS for ChatGPT-like interface
 def get_css_theme():
@@ -369,14 +391,17 @@ def generate_ai_response(text):
     except Exception as e:
         return f"I apologize, but I encountered an error: {str(e)}. Please try again."
 
+def save_current_chat():
+    """Save the current chat if it changed since the last save"""
+    return st.session_state.save_coordinator.save(
+        st.session_state.chat_id,
+        st.session_state.messages,
+        st.session_state.current_chat_title
+    )
+
 def start_new_chat():
     """Start a new chat session"""
-    if st.session_state.messages:
-        st.session_state.chat_manager.save_conversation(
-            st.session_state.chat_id, 
-            st.session_state.messages,
-            st.session_state.current_chat_title
-        )
+    save_current_chat()
     
     st.session_state.messages = []
     st.session_state.chat_id = str(uuid.uuid4())
@@ -386,16 +411,33 @@ def load_chat(chat_id):
     """Load a specific chat"""
     messages, metadata = st.session_state.chat_manager.load_conversation(chat_id)
     if messages:
-        if st.session_state.messages:
-            st.session_state.chat_manager.save_conversation(
-                st.session_state.chat_id,
-                st.session_state.messages,
-                st.session_state.current_chat_title
-            )
+        save_current_chat()
         
         st.session_state.messages = messages
         st.session_state.chat_id = chat_id
         st.session_state.current_chat_title = metadata.get('title', 'Untitled Chat')
+        
+        # A freshly loaded chat matches storage; don't write it back until it changes
+        st.session_state.save_coordinator.mark_saved(chat_id, messages, st.session_state.current_chat_title)
+
+def list_history():
+    """Newest conversations, one keyset page per "Load more" click"""
+    conversations = []
+    before = ()
+    for _ in range(st.session_state.history_pages):
+        page = st.session_state.chat_manager.list_conversations(HISTORY_PAGE_SIZE, *before)
+        conversations.extend(page)
+        if len(page) < HISTORY_PAGE_SIZE:
+            break
+        before = (page[-1]['timestamp'], page[-1]['chat_id'])
+    return conversations
+
+def search_history(query, ranking):
+    """Search results, falling back to typo-tolerant title matches when an exact search finds nothing"""
+    conversations = st.session_state.chat_manager.search_conversations(query, ranking=ranking)
+    if not conversations and ranking == "recent":
+        conversations = st.session_state.chat_manager.search_conversations(query, ranking="fuzzy")
+    return conversations
 
 # Sidebar for chat history and controls
 with st.sidebar:
@@ -421,10 +463,25 @@ with st.sidebar:
     # Search and filters
     st.markdown("### 🔍 Search & Filter")
     search_query = st.text_input("Search conversations...", key="search_box")
+    ranking_modes = {
+        "Recent": "recent",
+        "As you type": "prefix",
+        "Relevance": "relevance",
+        "Hybrid": "hybrid",
+        "Fuzzy titles": "fuzzy",
+        "Semantic": "semantic",
+        "Passages": "passages"
+    }
+    if st.session_state.chat_manager.supports_full_text():
+        ranking_modes["Full text"] = "full_text"
+    ranking = ranking_modes[st.radio(
+        "Rank results by", list(ranking_modes), key="search_ranking", horizontal=True,
+        help='Full text supports "exact phrases", prefix* and AND/OR/NOT'
+    )]
     
     # Advanced search options
     with st.expander("🔧 Advanced Search"):
-        search_type = st.selectbox("Search Type", ["Content", "Date Range", "Message Count"])
+        search_type = st.selectbox("Search Type", ["Content", "Hybrid", "Keywords", "Date Range", "Message Count", "Combined Filters"])
         
         if search_type == "Date Range":
             start_date = st.date_input("Start Date", datetime.now() - timedelta(days=30))
@@ -434,7 +491,24 @@ with st.sidebar:
                     st.session_state.chat_manager, start_date, end_date
                 )
             else:
-                conversations = st.session_state.chat_manager.get_all_conversations()
+                conversations = list_history()
+        
+        elif search_type == "Hybrid":
+            hybrid_query = st.text_input("Words or a description", key="hybrid_query")
+            if st.button("Search by Words and Meaning") and hybrid_query:
+                conversations = AdvancedSearch.search_hybrid(st.session_state.chat_manager, hybrid_query)
+            else:
+                conversations = list_history()
+        
+        elif search_type == "Keywords":
+            keywords_text = st.text_input("Keywords (comma separated)")
+            match_all = st.checkbox("Match all keywords")
+            if st.button("Search by Keywords"):
+                conversations = AdvancedSearch.search_by_keywords(
+                    st.session_state.chat_manager, keywords_text.split(","), "all" if match_all else "any"
+                )
+            else:
+                conversations = list_history()
         
         elif search_type == "Message Count":
             min_msgs = st.number_input("Min Messages", min_value=0, value=0)
@@ -444,23 +518,38 @@ with st.sidebar:
                     st.session_state.chat_manager, min_msgs, max_msgs
                 )
             else:
-                conversations = st.session_state.chat_manager.get_all_conversations()
+                conversations = list_history()
+        elif search_type == "Combined Filters":
+            start_date = st.date_input("Start Date", datetime.now() - timedelta(days=30), key="filter_start")
+            end_date = st.date_input("End Date", datetime.now(), key="filter_end")
+            min_msgs = st.number_input("Min Messages", min_value=0, value=0, key="filter_min")
+            max_msgs = st.number_input("Max Messages", min_value=1, value=1000, key="filter_max")
+            content_types = st.multiselect("Request type", list(MetadataTable.CONTENT_TYPES))
+            sort_by = st.selectbox("Sort by", list(MetadataTable.SORT_KEYS))
+            if st.button("Apply Filters"):
+                conversations = st.session_state.chat_manager.filter_conversations(
+                    start_date, end_date, min_msgs, max_msgs, content_types, sort_by
+                )
+            else:
+                conversations = list_history()
+        
         else:
             if search_query:
-                conversations = st.session_state.chat_manager.search_conversations(search_query)
+                conversations = search_history(search_query, ranking)
             else:
-                conversations = st.session_state.chat_manager.get_all_conversations()
+                conversations = list_history()
     
     # Get conversations based on search
     if not 'conversations' in locals():
         if search_query:
-            conversations = st.session_state.chat_manager.search_conversations(search_query)
+            conversations = search_history(search_query, ranking)
         else:
-            conversations = st.session_state.chat_manager.get_all_conversations()
+            conversations = list_history()
     
     # Display conversations
     st.markdown("### 💬 Chat History")
-    for conv in conversations[:20]:
+    visible_limit = HISTORY_PAGE_SIZE * st.session_state.history_pages
+    for conv in conversations[:visible_limit]:
         chat_preview = conv['title'][:35] + ("..." if len(conv['title']) > 35 else "")
         
         col1, col2 = st.columns([4, 1])
@@ -472,12 +561,39 @@ with st.sidebar:
             ):
                 load_chat(conv['chat_id'])
                 st.rerun()
+            if conv.get('snippet'):
+                # Full-text hits show why the chat matched
+                st.markdown(
+                    f'<div style="font-size: 12px; opacity: 0.8;">{ChatUtils.format_snippet(conv["snippet"])}'
+                    f' <span style="opacity: 0.6;">({sum(len(m["offsets"]) for m in conv["matches"])} hits)</span></div>',
+                    unsafe_allow_html=True
+                )
+            elif 'passage_position' in conv:
+                # Passage hits point at the message that matched best
+                st.markdown(
+                    f'<div style="font-size: 12px; opacity: 0.6;">best match: {conv["passage_role"]} message '
+                    f'#{conv["passage_position"] + 1} ({conv["score"]})</div>',
+                    unsafe_allow_html=True
+                )
+            elif 'bm25_rank' in conv:
+                # Hybrid hits show where each retriever ranked the chat
+                signals = " · ".join(
+                    f"{name} #{conv[f'{signal}_rank']} ({conv[f'{signal}_score']})"
+                    if conv[f'{signal}_rank'] else f"{name} –"
+                    for name, signal in (("words", "bm25"), ("meaning", "semantic"))
+                )
+                st.markdown(f'<div style="font-size: 12px; opacity: 0.6;">{signals}</div>', unsafe_allow_html=True)
         
         with col2:
             if st.button("🗑️", key=f"delete_{conv['chat_id']}", help="Delete chat"):
                 st.session_state.chat_manager.delete_conversation(conv['chat_id'])
                 st.rerun()
     
+    if len(conversations) >= visible_limit:
+        if st.button("⬇️ Load more", key="load_more", use_container_width=True):
+            st.session_state.history_pages += 1
+            st.rerun()
+    
     # Export options
     if st.session_state.messages:
         st.markdown("---")
@@ -509,7 +625,7 @@ with st.sidebar:
     # Footer stats
     st.markdown("---")
     st.markdown("**💾 Auto-save enabled**")
-    st.markdown(f"**📊 Total chats:** {len(conversations)}")
+    st.markdown(f"**📊 Total chats:** {st.session_state.chat_manager.count_conversations()}")
     if st.session_state.messages:
         st.markdown(f"**💬 Current messages:** {len(st.session_state.messages)}")
 
@@ -582,10 +698,33 @@ with main_col:
             stats_html = ""
             
             if st.session_state.show_stats:
-                stats = get_response_stats(message["content"])
+                # Rewrites are scored against the text the user asked to rewrite
+                previous = st.session_state.messages[i - 1] if i else None
+                source = None
+                if previous and previous["role"] == "user" and \
+                        AIResponseHandler.detect_content_type(previous["content"]) == 'rewrite':
+                    source = previous["content"]
+                stats = get_response_stats(message["content"], source)
+                originality_html = ""
+                if 'originality' in stats:
+                    report = stats['originality']
+                    originality_html = (
+                        f" • 🧬 {report['originality']:.0%} original • {report['ngram_overlap']:.0%} shared 3-grams"
+                        f" • longest copied run {report['longest_copied_run']} words"
+                        f" • shingle Jaccard {report['shingle_jaccard']:.2f}"
+                    )
+                    overlaps = st.session_state.chat_manager.check_plagiarism(
+                        message["content"], exclude_chat_id=st.session_state.chat_id, limit=3
+                    )
+                    if overlaps:
+                        originality_html += "<br>🔎 Overlaps " + " • ".join(
+                            f"{ChatUtils.clean_text(row.get('title', row['name']))[:30]}"
+                            f" ({len(row['passages'])} passages, {row['coverage']:.0%} of fingerprints)"
+                            for row in overlaps
+                        )
                 stats_html = f"""
                 <div class="message-stats">
-                    📊 {stats['word_count']} words • {stats['character_count']} chars • {stats['reading_time']}
+                    📊 {stats['word_count']} words • {stats['character_count']} chars • {stats['reading_time']}{originality_html}
                 </div>
                 """
             
@@ -637,22 +776,12 @@ if send_button and user_input.strip():
         response = generate_ai_response(user_input)
         st.session_state.messages.append({"role": "assistant", "content": response})
     
-    # Auto-save conversation
-    if len(st.session_state.messages) % 4 == 0:
-        st.session_state.chat_manager.save_conversation(
-            st.session_state.chat_id,
-            st.session_state.messages,
-            st.session_state.current_chat_title
-        )
+    # Auto-save conversation (the rerun's end-of-script save is then a no-op)
+    save_current_chat()
     
     # Clear input and rerun
     st.session_state.user_input = ""
     st.rerun()
 
-# Auto-save on app interaction
-if st.session_state.messages and len(st.session_state.messages) > 0:
-    st.session_state.chat_manager.save_conversation(
-        st.session_state.chat_id,
-        st.session_state.messages,
-        st.session_state.current_chat_title
-    )
+# Auto-save on app interaction, skipped unless the chat actually changed
+save_current_chat()
@@ -1,9 +1,15 @@
 import streamlit as st
 import google.generativeai as genai
-import chromadb
 import uuid
 from datetime import datetime
 import json
+from embeddings import default_embedder
+from vector_index import ChromaChunkStore, QuantizedVectorIndex
+
+try:
+    import chromadb
+except ImportError:  # fall back to the local int8 vector index
+    chromadb = None
 
 # Page configuration
 st.set_page_config(
@@ -16,20 +22,25 @@ st.set_page_config(
 # Initialize ChromaDB
 @st.cache_resource
 def init_vector_db():
+    embedder = default_embedder()
+    if chromadb is None:
+        return None, ChromaChunkStore(QuantizedVectorIndex("./chat_vectors", dim=embedder.dim), embedder)
     client = chromadb.PersistentClient(path="./chat_history")
+    # Message-level chunks; the old one-document-per-chat "conversations" collection is no longer written
     collection = client.get_or_create_collection(
-        name="conversations",
-        metadata={"hnsw:space": "cosine"}
+        name="conversation_chunks",
+        metadata={"hnsw:space": "cosine"},
+        embedding_function=embedder
     )
-    return client, collection
+    return client, ChromaChunkStore(collection, embedder)
 
 # Initialize session state
 if 'messages' not in st.session_state:
     st.session_state.messages = []
 if 'chat_id' not in st.session_state:
     st.session_state.chat_id = str(uuid.uuid4())
-if 'db_client' not in st.session_state:
-    st.session_state.db_client, st.session_state.collection = init_vector_db()
+if 'chunk_store' not in st.session_state:
+    st.session_state.db_client, st.session_state.chunk_store = init_vector_db()
 
 # Custom CSS for ChatGPT-like interface
 st.markdown("""
@@ -249,23 +260,10 @@ model = genai.GenerativeModel('gemini-2.5-pro')
 def save_conversation_to_db(chat_id, messages):
     """Save conversation to vector database"""
     try:
-        conversation_text = ""
-        for msg in messages:
-            conversation_text += f"{msg['role']}: {msg['content']}\n"
-        
-        # Create metadata
-        metadata = {
-            "chat_id": chat_id,
-            "timestamp": datetime.now().isoformat(),
-            "message_count": len(messages)
-        }
-        
-        # Save to vector database
-        st.session_state.collection.add(
-            documents=[conversation_text],
-            metadatas=[metadata],
-            ids=[chat_id]
-        )
+        # Only new or changed chunks are embedded and upserted
+        st.session_state.chunk_store.upsert_conversation(chat_id, messages, {
+            "timestamp": datetime.now().isoformat()
+        })
     except Exception as e:
         st.error(f"Error saving conversation: {e}")
 
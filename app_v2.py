@@ -1,6 +1,5 @@
 import streamlit as st
 import google.generativeai as genai
-import chromadb
 import uuid
 from datetime import datetime
 import json
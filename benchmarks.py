@@ -0,0 +1,444 @@
+"""Storage and search benchmarks.
+
+Run from the repository root, e.g.:
+
+    python benchmarks.py concurrent-writes --backend json --processes 8 --saves 50
+    python benchmarks.py metadata-scan --size-mb 500
+    python benchmarks.py trigram-search --conversations 50000
+    python benchmarks.py embedding-cache --conversations 10000 --changed 0.05
+    python benchmarks.py vector-index --rows 1000000 --dim 256
+    python benchmarks.py fingerprint-check --conversations 5000 20000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from embeddings import CachedEmbedder, EmbeddingCache, HashingEmbedder
+from search_index import FingerprintIndex, TrigramIndex, conversation_matches
+from storage import create_storage, conversation_metadata, scan_metadata, write_batch
+import numpy as np
+
+from vector_index import QuantizedVectorIndex, SemanticIndex
+
+
+def make_conversation(chat_id, n_messages=4, words=30):
+    """Synthetic conversation shaped like the ones ChatHistoryManager saves"""
+    now = datetime.now()
+    messages = []
+    for i in range(n_messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = " ".join(f"word{(i * 7 + j) % 997}" for j in range(words))
+        messages.append({"role": role, "content": f"{chat_id} {content}"})
+    return {
+        "chat_id": chat_id,
+        "title": f"Conversation {chat_id}",
+        "messages": messages,
+        "timestamp": now.isoformat(),
+        "message_count": len(messages),
+        "created_date": now.strftime("%Y-%m-%d"),
+        "created_time": now.strftime("%H:%M")
+    }
+
+
+def storage_options(backend, workdir):
+    """Paths for a backend inside a scratch directory"""
+    names = {"json": "history.json", "journal": "history.jsonl", "sqlite": "history.db", "sharded": "shards"}
+    options = {"path": os.path.join(workdir, names[backend])}
+    if backend != "json":
+        options["legacy_path"] = None
+    return options
+
+
+def _legacy_put(path, chat_id, conversation):
+    """The original unlocked read-modify-write, kept for comparison"""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    data["conversations"][chat_id] = conversation
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def _writer(backend, options, worker, saves, barrier, errors):
+    storage = None if backend == "legacy" else create_storage(backend, **options)
+    barrier.wait()
+    for i in range(saves):
+        chat_id = f"w{worker}-{i}"
+        try:
+            if storage is None:
+                _legacy_put(options["path"], chat_id, make_conversation(chat_id))
+            else:
+                storage.put(chat_id, make_conversation(chat_id))
+        except Exception:
+            errors.value += 1
+
+
+def bench_concurrent_writes(backend="json", processes=8, saves=50):
+    """Hammer one store from several processes and count lost updates.
+
+    backend may also be "legacy" to run the pre-locking JSON write path.
+    """
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        if backend == "legacy":
+            options = {"path": os.path.join(workdir, "history.json")}
+            with open(options["path"], 'w') as f:
+                json.dump({"conversations": {}}, f)
+        else:
+            options = storage_options(backend, workdir)
+            create_storage(backend, **options)
+
+        barrier = multiprocessing.Barrier(processes + 1)
+        errors = multiprocessing.Value('i', 0)
+        workers = [multiprocessing.Process(target=_writer, args=(backend, options, w, saves, barrier, errors))
+                   for w in range(processes)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        expected = processes * saves
+        if backend == "legacy":
+            try:
+                with open(options["path"], 'r') as f:
+                    stored = len(json.load(f)["conversations"])
+            except ValueError:
+                stored = 0
+        else:
+            stored = len(create_storage(backend, **options).metadata())
+        return {
+            "backend": backend,
+            "processes": processes,
+            "saves": expected,
+            "seconds": round(elapsed, 3),
+            "saves_per_second": round(expected / elapsed, 1),
+            "stored": stored,
+            "lost_updates": expected - stored,
+            "errors": errors.value
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def write_history_file(path, size_mb, n_messages=40, words=120):
+    """Write a synthetic chat_history.json of roughly size_mb, one conversation at a time"""
+    target = size_mb * 1024 * 1024
+    count = 0
+    with open(path, 'w') as f:
+        f.write('{\n  "conversations": {')
+        while f.tell() < target:
+            chat_id = f"chat-{count:08d}"
+            f.write(("," if count else "") + "\n    " + json.dumps(chat_id) + ": ")
+            f.write(json.dumps(make_conversation(chat_id, n_messages, words), indent=2))
+            count += 1
+        f.write("\n  }\n}\n")
+    return count
+
+
+def _measure(fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_metadata_scan(size_mb=100):
+    """Compare listing metadata via json.load with the streaming mmap scan"""
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        path = os.path.join(workdir, "chat_history.json")
+        conversations = write_history_file(path, size_mb)
+
+        def json_load_path():
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return [conversation_metadata(chat_id, conv) for chat_id, conv in data["conversations"].items()]
+
+        def streaming_path():
+            return [conversation_metadata(chat_id, fields) for chat_id, fields in scan_metadata(path)]
+
+        expected, load_seconds, load_peak = _measure(json_load_path)
+        rows, scan_seconds, scan_peak = _measure(streaming_path)
+        return {
+            "file_mb": round(os.path.getsize(path) / 1024 / 1024, 1),
+            "conversations": conversations,
+            "identical": rows == expected,
+            "json_load_seconds": round(load_seconds, 3),
+            "scan_seconds": round(scan_seconds, 3),
+            "json_load_peak_mb": round(load_peak / 1024 / 1024, 1),
+            "scan_peak_mb": round(scan_peak / 1024 / 1024, 1)
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def make_corpus(count, seed=0, n_messages=6, words=40):
+    """Conversations drawn from a random vocabulary so trigram postings have realistic spread"""
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(alphabet) for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    for i in range(count):
+        chat_id = f"chat-{i:08d}"
+        conversation = make_conversation(chat_id, n_messages, 0)
+        conversation["title"] = " ".join(rng.choices(vocabulary, k=4)).title()
+        for msg in conversation["messages"]:
+            msg["content"] = " ".join(rng.choices(vocabulary, k=words))
+        conversation["timestamp"] = f"2024-01-01T00:00:00.{i:06d}"
+        yield chat_id, conversation
+
+
+def bench_trigram_search(conversations=50000, queries=50, n_results=10):
+    """Compare substring search by full scan with the trigram-prefiltered index"""
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        storage = create_storage("sqlite", cache=True, **storage_options("sqlite", workdir))
+        write_batch(storage, make_corpus(conversations))
+        storage.metadata()
+
+        rng = random.Random(1)
+        samples = []
+        for _ in range(queries):
+            _, conversation = next(make_corpus(1, seed=rng.randint(0, conversations)))
+            text = conversation["messages"][0]["content"]
+            start = rng.randint(0, len(text) - 8)
+            samples.append(text[start:start + rng.randint(4, 8)])
+        samples += ["zz", "qqqqq"]
+
+        def full_scan(query):
+            query_lower = query.lower()
+            rows = [conversation_metadata(chat_id, conv) for chat_id, conv in storage.conversations()
+                    if conversation_matches(conv, query_lower)]
+            rows.sort(key=lambda row: row['timestamp'], reverse=True)
+            return rows[:n_results]
+
+        index_path = os.path.join(workdir, "history.trigram.idx")
+        start = time.perf_counter()
+        index = TrigramIndex(index_path)
+        index.sync(storage)
+        build_seconds = time.perf_counter() - start
+        index.save()
+        start = time.perf_counter()
+        index = TrigramIndex(index_path)
+        load_seconds = time.perf_counter() - start
+        index.sync(storage)
+
+        start = time.perf_counter()
+        expected = [full_scan(query) for query in samples]
+        scan_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        results = [index.search(query, n_results, storage) for query in samples]
+        index_seconds = time.perf_counter() - start
+        return {
+            "conversations": conversations,
+            "queries": len(samples),
+            "identical": results == expected,
+            "build_seconds": round(build_seconds, 3),
+            "load_seconds": round(load_seconds, 3),
+            "index_mb": round(os.path.getsize(index_path) / 1024 / 1024, 1),
+            "scan_ms_per_query": round(scan_seconds / len(samples) * 1000, 2),
+            "index_ms_per_query": round(index_seconds / len(samples) * 1000, 2)
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_embedding_cache(conversations=10000, changed=0.05):
+    """Re-index a history with a cold and a warm embedding cache after editing a fraction of it"""
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        storage = create_storage("sqlite", cache=True, **storage_options("sqlite", workdir))
+        write_batch(storage, make_corpus(conversations))
+        embedder = CachedEmbedder(HashingEmbedder(), EmbeddingCache(os.path.join(workdir, "embedding_cache.db")))
+
+        start = time.perf_counter()
+        SemanticIndex(embedder=embedder).sync(storage)
+        cold_seconds = time.perf_counter() - start
+
+        edited = list(make_corpus(int(conversations * changed), seed=1))
+        write_batch(storage, [(f"chat-{i * 7 % conversations:08d}", conversation) for i, (_, conversation)
+                              in enumerate(edited)])
+        start = time.perf_counter()
+        SemanticIndex(embedder=embedder).sync(storage)
+        warm_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        SemanticIndex(embedder=HashingEmbedder()).sync(storage)
+        uncached_seconds = time.perf_counter() - start
+        return {
+            "conversations": conversations,
+            "changed": len(edited),
+            "cold_cache_seconds": round(cold_seconds, 3),
+            "warm_cache_seconds": round(warm_seconds, 3),
+            "uncached_seconds": round(uncached_seconds, 3),
+            "cache_entries": len(embedder.cache)
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def clustered_vectors(rows, dim, clusters=1000, seed=0, block=65536):
+    """Unit vectors scattered around random centroids, yielded in blocks, like chunk embeddings of related chats"""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((clusters, dim), dtype=np.float32)
+    for start in range(0, rows, block):
+        size = min(block, rows - start)
+        vectors = centroids[rng.integers(0, clusters, size)] + rng.standard_normal((size, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        yield start, vectors
+
+
+def bench_vector_index(rows=200000, dim=256, queries=100, n_results=10):
+    """Recall and latency of the int8 memory-mapped index against exact float32 search"""
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        exact = np.zeros((rows, dim), dtype=np.float32)
+        index = QuantizedVectorIndex(os.path.join(workdir, "vectors"), dim=dim)
+        start = time.perf_counter()
+        for offset, vectors in clustered_vectors(rows, dim):
+            exact[offset:offset + len(vectors)] = vectors
+            index.upsert([f"row-{offset + i}" for i in range(len(vectors))], vectors,
+                         metadatas=[{"chat_id": f"chat-{(offset + i) // 8}"} for i in range(len(vectors))])
+        index.save()
+        build_seconds = time.perf_counter() - start
+
+        rng = np.random.default_rng(1)
+        samples = exact[rng.integers(0, rows, queries)] + 0.5 * rng.standard_normal((queries, dim), dtype=np.float32)
+        samples /= np.linalg.norm(samples, axis=1, keepdims=True)
+
+        start = time.perf_counter()
+        expected = []
+        for query in samples:
+            scores = exact @ query
+            top = np.argpartition(-scores, n_results)[:n_results]
+            expected.append(set(top.tolist()))
+        exact_seconds = time.perf_counter() - start
+        del exact
+
+        start = time.perf_counter()
+        index = QuantizedVectorIndex(os.path.join(workdir, "vectors"), dim=dim)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        results = [index.search(query, n_results) for query in samples]
+        index_seconds = time.perf_counter() - start
+        recall = sum(len(expected_rows & {position for position, _ in hits})
+                     for expected_rows, hits in zip(expected, results)) / (queries * n_results)
+        return {
+            "rows": rows,
+            "dim": dim,
+            "queries": queries,
+            f"recall_at_{n_results}": round(recall, 4),
+            "build_seconds": round(build_seconds, 3),
+            "load_seconds": round(load_seconds, 3),
+            "float32_mb": round(rows * dim * 4 / 1024 / 1024, 1),
+            "int8_mb": round(os.path.getsize(os.path.join(workdir, "vectors", "vectors.i8")) / 1024 / 1024, 1),
+            "exact_float32_ms_per_query": round(exact_seconds / queries * 1000, 2),
+            "int8_ms_per_query": round(index_seconds / queries * 1000, 2)
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_fingerprint_check(conversations=20000, queries=50, query_words=400):
+    """Build the winnowing index over a synthetic history and time plagiarism checks of rewrite-sized texts"""
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        storage = create_storage("sqlite", cache=True, **storage_options("sqlite", workdir))
+        corpus = list(make_corpus(conversations))
+        write_batch(storage, corpus)
+        index = FingerprintIndex(os.path.join(workdir, "history.fingerprint.idx"))
+        start = time.perf_counter()
+        index.sync(storage)
+        build_seconds = time.perf_counter() - start
+        index.save()
+
+        # Each query is fresh text with a 30-word passage copied from a random stored message
+        rng = random.Random(1)
+        _, filler = next(make_corpus(1, seed=conversations + 1, n_messages=1, words=query_words))
+        filler = filler["messages"][0]["content"].split()
+        samples = []
+        for _ in range(queries):
+            chat_id, conversation = corpus[rng.randrange(conversations)]
+            copied = conversation["messages"][rng.randrange(len(conversation["messages"]))]["content"].split()[:30]
+            at = rng.randrange(len(filler))
+            samples.append((chat_id, " ".join(filler[:at] + copied + filler[at:])))
+
+        start = time.perf_counter()
+        results = [index.check(text, limit=5) for _, text in samples]
+        check_seconds = time.perf_counter() - start
+        found = sum(any(row["name"] == chat_id for row in rows) for (chat_id, _), rows in zip(samples, results))
+        return {
+            "conversations": conversations,
+            "queries": queries,
+            "query_words": query_words + 30,
+            "copied_source_found": round(found / queries, 3),
+            "build_seconds": round(build_seconds, 3),
+            "db_mb": round(os.path.getsize(index.db_path) / 1024 / 1024, 1),
+            "check_ms_per_query": round(check_seconds / queries * 1000, 2)
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    concurrent = subparsers.add_parser("concurrent-writes", help="multi-process save stress test")
+    concurrent.add_argument("--backend", default="all",
+                            choices=["all", "legacy", "json", "journal", "sqlite", "sharded"])
+    concurrent.add_argument("--processes", type=int, default=8)
+    concurrent.add_argument("--saves", type=int, default=50, help="saves per process")
+
+    scan = subparsers.add_parser("metadata-scan", help="json.load vs streaming metadata listing")
+    scan.add_argument("--size-mb", type=int, default=100)
+
+    trigram = subparsers.add_parser("trigram-search", help="full-scan vs trigram-index substring search")
+    trigram.add_argument("--conversations", type=int, default=50000)
+    trigram.add_argument("--queries", type=int, default=50)
+
+    cache = subparsers.add_parser("embedding-cache", help="semantic re-index with cold vs warm embedding cache")
+    cache.add_argument("--conversations", type=int, default=10000)
+    cache.add_argument("--changed", type=float, default=0.05, help="fraction of conversations edited")
+
+    vectors = subparsers.add_parser("vector-index", help="int8 memory-mapped index vs exact float32 search")
+    vectors.add_argument("--rows", type=int, default=200000)
+    vectors.add_argument("--dim", type=int, default=256)
+    vectors.add_argument("--queries", type=int, default=100)
+
+    fingerprints = subparsers.add_parser("fingerprint-check", help="winnowing plagiarism checks vs corpus size")
+    fingerprints.add_argument("--conversations", type=int, nargs="+", default=[5000, 20000])
+    fingerprints.add_argument("--queries", type=int, default=50)
+
+    args = parser.parse_args()
+    if args.benchmark == "concurrent-writes":
+        backends = ["legacy", "json", "journal", "sqlite", "sharded"] if args.backend == "all" else [args.backend]
+        for backend in backends:
+            print(json.dumps(bench_concurrent_writes(backend, args.processes, args.saves)))
+    elif args.benchmark == "metadata-scan":
+        print(json.dumps(bench_metadata_scan(args.size_mb)))
+    elif args.benchmark == "trigram-search":
+        print(json.dumps(bench_trigram_search(args.conversations, args.queries)))
+    elif args.benchmark == "embedding-cache":
+        print(json.dumps(bench_embedding_cache(args.conversations, args.changed)))
+    elif args.benchmark == "vector-index":
+        print(json.dumps(bench_vector_index(args.rows, args.dim, args.queries)))
+    elif args.benchmark == "fingerprint-check":
+        for conversations in args.conversations:
+            print(json.dumps(bench_fingerprint_check(conversations, args.queries)))
+
+
+if __name__ == "__main__":
+    main()
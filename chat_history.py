@@ -3,25 +3,43 @@ import json
 import os
 from datetime import datetime
 import uuid
+import hashlib
+import glob
+from concurrent.futures import ThreadPoolExecutor
+from storage import create_storage, conversation_metadata, date_range_epochs, TimestampIndex
+from search_index import SEARCH_INDEXES, KeywordMatcher, conversation_matches, reciprocal_rank_fusion
+from vector_index import VECTOR_INDEXES
+
+INDEXES = {**SEARCH_INDEXES, **VECTOR_INDEXES}
 
 class ChatHistoryManager:
-    def __init__(self):
-        self.history_file = "chat_history.json"
-        self.ensure_history_file()
+    def __init__(self, backend="json", cache=False, write_behind=False, substring_index=False, **storage_options):
+        self.storage = create_storage(backend, cache=cache, write_behind=write_behind, **storage_options)
+        self.history_file = self.storage.path
+        self.substring_index = substring_index
+        self.indexes = {}
+        # Threads are started on first use; hybrid search runs its two retrievers side by side
+        self._search_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-search")
+    
+    def get_index(self, kind):
+        """Get a search index by name, loading it on first use and syncing it with storage"""
+        if kind not in self.indexes:
+            self.indexes[kind] = INDEXES[kind](path=f"{self.history_file}.{kind}.idx")
+        index = self.indexes[kind]
+        index.sync(self.storage)
+        return index
+    
+    def attach_index(self, name, index):
+        """Keep an external index (anything with add/remove, such as a ChromaChunkStore) in step with saves and deletes"""
+        self.indexes[name] = index
     
     def ensure_history_file(self):
         """Ensure the history file exists"""
-        if not os.path.exists(self.history_file):
-            with open(self.history_file, 'w') as f:
-                json.dump({"conversations": {}}, f)
+        self.storage.ensure_file()
     
     def save_conversation(self, chat_id, messages, title=None):
-        """Save a conversation to JSON file"""
+        """Save a conversation to the configured storage backend"""
         try:
-            # Load existing data
-            with open(self.history_file, 'r') as f:
-                data = json.load(f)
-            
             # Generate title if not provided
             if not title and messages:
                 title = self.generate_title(messages[0]['content'])
@@ -30,7 +48,7 @@ class ChatHistoryManager:
             conversation_data = {
                 "chat_id": chat_id,
                 "title": title or "Untitled Chat",
-                "messages": messages,
+                "messages": list(messages),
                 "timestamp": datetime.now().isoformat(),
                 "message_count": len(messages),
                 "created_date": datetime.now().strftime("%Y-%m-%d"),
@@ -38,11 +56,9 @@ class ChatHistoryManager:
             }
             
             # Save conversation
-            data["conversations"][chat_id] = conversation_data
-            
-            # Write back to file
-            with open(self.history_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            self.storage.put(chat_id, conversation_data)
+            for index in self.indexes.values():
+                index.add(chat_id, conversation_data)
             
             return True
         except Exception as e:
@@ -52,12 +68,10 @@ class ChatHistoryManager:
     def load_conversation(self, chat_id):
         """Load a conversation by chat_id"""
         try:
-            with open(self.history_file, 'r') as f:
-                data = json.load(f)
-            
-            if chat_id in data["conversations"]:
-                conv_data = data["conversations"][chat_id]
-                return conv_data["messages"], {
+            conv_data = self.storage.get(chat_id)
+            if conv_data is not None:
+                # Copy so appending in the session never mutates cached history
+                return list(conv_data["messages"]), {
                     "title": conv_data.get("title", "Untitled"),
                     "timestamp": conv_data.get("timestamp", ""),
                     "created_date": conv_data.get("created_date", ""),
@@ -71,19 +85,11 @@ class ChatHistoryManager:
     def get_all_conversations(self):
         """Get all conversations metadata"""
         try:
-            with open(self.history_file, 'r') as f:
-                data = json.load(f)
+            if hasattr(self.storage, "metadata_page"):
+                # Already kept in newest-first order
+                return self.storage.metadata_page(None)
             
-            conversations = []
-            for chat_id, conv_data in data["conversations"].items():
-                conversations.append({
-                    'chat_id': chat_id,
-                    'title': conv_data.get('title', 'Untitled'),
-                    'timestamp': conv_data.get('timestamp', ''),
-                    'message_count': conv_data.get('message_count', 0),
-                    'date': conv_data.get('created_date', ''),
-                    'time': conv_data.get('created_time', '')
-                })
+            conversations = self.storage.metadata()
             
             # Sort by timestamp (newest first)
             conversations.sort(key=lambda x: x['timestamp'], reverse=True)
@@ -92,51 +98,135 @@ class ChatHistoryManager:
             st.error(f"Error getting conversations: {e}")
             return []
     
+    def list_conversations(self, limit=20, before_timestamp=None, before_chat_id=None):
+        """Get one page of conversation metadata, newest first.
+
+        Pass the timestamp and chat_id of the last row of a page as the cursor
+        to get the next page.
+        """
+        try:
+            if hasattr(self.storage, "metadata_page"):
+                return self.storage.metadata_page(limit, before_timestamp, before_chat_id)
+            
+            return TimestampIndex(self.storage.metadata()).page(limit, before_timestamp, before_chat_id)
+        except Exception as e:
+            st.error(f"Error listing conversations: {e}")
+            return []
+    
+    def count_conversations(self):
+        """Get the number of stored conversations"""
+        try:
+            if hasattr(self.storage, "count"):
+                return self.storage.count()
+            return len(self.storage.metadata())
+        except Exception as e:
+            st.error(f"Error counting conversations: {e}")
+            return 0
+    
+    def get_conversations_between(self, start_date, end_date):
+        """Get metadata of conversations saved between two dates (inclusive), newest first"""
+        try:
+            if hasattr(self.storage, "metadata_between"):
+                return self.storage.metadata_between(start_date, end_date)
+            
+            index = TimestampIndex(self.storage.metadata())
+            return index.between(*date_range_epochs(start_date, end_date))
+        except Exception as e:
+            st.error(f"Error filtering conversations: {e}")
+            return []
+    
+    def get_conversations_by_message_count(self, min_messages, max_messages):
+        """Get metadata of conversations with a message count in [min_messages, max_messages]"""
+        try:
+            if hasattr(self.storage, "metadata_by_message_count"):
+                return self.storage.metadata_by_message_count(min_messages, max_messages)
+            
+            return self.filter_conversations(min_messages=min_messages, max_messages=max_messages)
+        except Exception as e:
+            st.error(f"Error filtering conversations: {e}")
+            return []
+    
+    def filter_conversations(self, start_date=None, end_date=None, min_messages=None, max_messages=None,
+                             content_types=None, sort_by="newest", limit=None):
+        """Combined metadata filters evaluated as vectorized masks over the columnar metadata table.
+        
+        Dates are inclusive days, message bounds inclusive; content_types is a list of
+        AIResponseHandler content types of the first user message. sort_by is one of
+        "newest", "oldest", "messages" or "characters".
+        """
+        try:
+            start_epoch = date_range_epochs(start_date, start_date)[0] if start_date else None
+            end_epoch = date_range_epochs(end_date, end_date)[1] if end_date else None
+            return self.get_index("columns").query(
+                start_epoch, end_epoch, min_messages, max_messages,
+                content_types=content_types, sort_by=sort_by, limit=limit
+            )
+        except Exception as e:
+            st.error(f"Error filtering conversations: {e}")
+            return []
+    
     def delete_conversation(self, chat_id):
         """Delete a conversation"""
         try:
-            with open(self.history_file, 'r') as f:
-                data = json.load(f)
-            
-            if chat_id in data["conversations"]:
-                del data["conversations"][chat_id]
-                
-                with open(self.history_file, 'w') as f:
-                    json.dump(data, f, indent=2)
-                return True
-            return False
+            deleted = self.storage.delete(chat_id)
+            for index in self.indexes.values():
+                index.remove(chat_id)
+            return deleted
         except Exception as e:
             st.error(f"Error deleting conversation: {e}")
             return False
     
-    def search_conversations(self, query, n_results=10):
-        """Search conversations by content"""
+    def search_conversations(self, query, n_results=10, ranking="recent"):
+        """Search conversations by content.
+        
+        ranking="recent" returns substring matches newest first; ranking="relevance"
+        returns word matches ranked by BM25, each row carrying its score;
+        ranking="full_text" runs an FTS5 query (phrases, prefix*) on backends
+        that support it, each row carrying a highlighted snippet and match offsets;
+        ranking="fuzzy" matches title words within a small edit distance;
+        ranking="prefix" treats every query word as a word prefix (search as you
+        type), newest first; ranking="semantic" ranks by embedding similarity;
+        ranking="passages" ranks by the best-matching message chunk in an
+        attached "chunks" store (see search_passages);
+        ranking="hybrid" fuses BM25 and semantic rankings (see hybrid_search).
+        """
         try:
-            with open(self.history_file, 'r') as f:
-                data = json.load(f)
+            if ranking == "hybrid":
+                return self.hybrid_search(query, n_results)
+            
+            if ranking == "semantic":
+                return self.get_index("semantic").search(query, n_results)
+            
+            if ranking == "passages":
+                return self.search_passages(query, n_results)
+            
+            if ranking == "fuzzy":
+                return self.get_index("fuzzy").search(query, n_results)
+            
+            if ranking == "prefix":
+                return self.get_index("prefix").search(query, n_results)
+            
+            if ranking == "full_text" and self.supports_full_text():
+                return self.storage.full_text_search(query, n_results)
+            
+            if ranking == "relevance":
+                index = self.get_index("bm25")
+                return [dict(index.rows[chat_id], score=round(score, 3))
+                        for chat_id, score in index.search(query, n_results)]
+            
+            if self.substring_index:
+                return self.get_index("trigram").search(query, n_results, self.storage)
+            
+            if hasattr(self.storage, "search"):
+                return self.storage.search(query)[:n_results]
             
             conversations = []
             query_lower = query.lower()
             
-            for chat_id, conv_data in data["conversations"].items():
+            for chat_id, conv_data in self.storage.conversations():
                 # Search in title and messages
-                title_match = query_lower in conv_data.get('title', '').lower()
-                
-                message_match = False
-                for msg in conv_data.get('messages', []):
-                    if query_lower in msg.get('content', '').lower():
-                        message_match = True
-                        break
-                
-                if title_match or message_match:
-                    conversations.append({
-                        'chat_id': chat_id,
-                        'title': conv_data.get('title', 'Untitled'),
-                        'timestamp': conv_data.get('timestamp', ''),
-                        'message_count': conv_data.get('message_count', 0),
-                        'date': conv_data.get('created_date', ''),
-                        'time': conv_data.get('created_time', '')
-                    })
+                if conversation_matches(conv_data, query_lower):
+                    conversations.append(conversation_metadata(chat_id, conv_data))
             
             # Sort by timestamp and limit results
             conversations.sort(key=lambda x: x['timestamp'], reverse=True)
@@ -145,6 +235,133 @@ class ChatHistoryManager:
             st.error(f"Error searching conversations: {e}")
             return []
     
+    def search_passages(self, query, n_results=10):
+        """Conversations ranked by their best-matching chunk in the attached ChromaChunkStore.
+        
+        Rows carry the chunk's score and the position and role of its message;
+        without an attached "chunks" store there are no results.
+        """
+        try:
+            chunks = self.indexes.get("chunks")
+            if chunks is None:
+                return []
+            results = []
+            for chat_id, score, chunk in chunks.search(query, n_results):
+                conv_data = self.storage.get(chat_id)
+                if conv_data is None:
+                    continue
+                row = conversation_metadata(chat_id, conv_data)
+                row.update(score=round(score, 3), passage_position=chunk['position'], passage_role=chunk['role'])
+                results.append(row)
+            return results
+        except Exception as e:
+            st.error(f"Error searching passages: {e}")
+            return []
+    
+    def hybrid_search(self, query, n_results=10, depth=50, k=60):
+        """BM25 and semantic search run concurrently and fused with reciprocal rank fusion.
+        
+        Each retriever returns its top depth conversations. Rows are ordered by
+        the fused score and carry each signal's rank and score (None when that
+        retriever did not return the conversation).
+        """
+        try:
+            lexical = self.get_index("bm25")
+            semantic = self.get_index("semantic")
+            bm25_future = self._search_pool.submit(lexical.search, query, depth)
+            semantic_future = self._search_pool.submit(semantic.search, query, depth)
+            semantic_rows = {row['chat_id']: row for row in semantic_future.result()}
+            rankings = {
+                "bm25": bm25_future.result(),
+                "semantic": [(chat_id, row['score']) for chat_id, row in semantic_rows.items()]
+            }
+            
+            results = []
+            for chat_id, score, signals in reciprocal_rank_fusion(rankings, k)[:n_results]:
+                row = dict(lexical.rows.get(chat_id) or semantic_rows[chat_id], score=round(score, 4))
+                for signal in rankings:
+                    rank, signal_score = signals.get(signal, (None, None))
+                    row[f"{signal}_rank"] = rank
+                    row[f"{signal}_score"] = None if signal_score is None else round(signal_score, 3)
+                results.append(row)
+            return results
+        except Exception as e:
+            st.error(f"Error in hybrid search: {e}")
+            return []
+    
+    def search_keywords(self, keywords, match="any", n_results=50):
+        """Substring search for several keywords in a single pass over the conversations.
+        
+        match="any" keeps conversations containing at least one keyword, match="all"
+        only those containing every keyword. Rows carry the matched keywords and a
+        score (how many matched) and are ordered by score, then newest first.
+        """
+        try:
+            matcher = KeywordMatcher(keywords)
+            if not matcher.keywords:
+                return []
+            required = len(matcher.keywords) if match == "all" else 1
+            
+            candidates = None
+            if self.substring_index:
+                candidates = self.get_index("trigram").keyword_candidates(matcher.keywords, match)
+            if candidates is None:
+                pairs = self.storage.conversations()
+            else:
+                pairs = ((chat_id, self.storage.get(chat_id)) for chat_id in candidates)
+            
+            results = []
+            for chat_id, conv_data in pairs:
+                if conv_data is None:
+                    continue
+                matched = matcher.match(conv_data)
+                if len(matched) >= required:
+                    row = conversation_metadata(chat_id, conv_data)
+                    row['matched_keywords'] = sorted(matched)
+                    row['score'] = len(matched)
+                    results.append(row)
+            
+            results.sort(key=lambda x: (x['score'], x['timestamp']), reverse=True)
+            return results[:n_results]
+        except Exception as e:
+            st.error(f"Error searching conversations: {e}")
+            return []
+    
+    def check_plagiarism(self, text, exclude_chat_id=None, limit=10):
+        """Stored messages and reference texts sharing passages with text (winnowing fingerprints).
+        
+        Pass the current chat's id as exclude_chat_id so a reply is not matched
+        against its own saved copy. History rows also carry the chat title.
+        """
+        try:
+            index = self.get_index("fingerprint")
+            results = index.check(text, limit, exclude_chat_id)
+            for row in results:
+                if row['source'] == "history" and row['name'] in index.rows:
+                    row['title'] = index.rows[row['name']]['title']
+            return results
+        except Exception as e:
+            st.error(f"Error checking for plagiarism: {e}")
+            return []
+    
+    def add_reference_corpus(self, directory, patterns=("*.txt", "*.md")):
+        """Fingerprint the text files under directory as reference documents; returns how many changed"""
+        try:
+            index = self.get_index("fingerprint")
+            changed = 0
+            for pattern in patterns:
+                for path in glob.glob(os.path.join(directory, "**", pattern), recursive=True):
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        changed += index.add_reference(os.path.relpath(path, directory), f.read())
+            return changed
+        except Exception as e:
+            st.error(f"Error indexing reference corpus: {e}")
+            return 0
+    
+    def supports_full_text(self):
+        """Whether the storage backend can answer FTS5 full-text queries"""
+        return getattr(self.storage, "full_text", False)
+    
     def generate_title(self, first_message):
         """Generate a title from the first message"""
         # Simple title generation - take first 50 characters
@@ -169,3 +386,33 @@ class ChatHistoryManager:
         except Exception as e:
             st.error(f"Error exporting conversation: {e}")
             return None
+
+
+class SaveCoordinator:
+    """Persist a session's conversation only when its content changed since the last save"""
+    
+    def __init__(self, chat_manager):
+        self.chat_manager = chat_manager
+        self.saved_revisions = {}
+    
+    @staticmethod
+    def revision(messages, title):
+        """Content hash of a conversation's title and messages"""
+        payload = json.dumps([title, messages], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+    
+    def mark_saved(self, chat_id, messages, title):
+        """Record the conversation as persisted, e.g. right after loading it"""
+        self.saved_revisions[chat_id] = self.revision(messages, title)
+    
+    def save(self, chat_id, messages, title):
+        """Save the conversation if it changed; returns True only when a write happened"""
+        if not messages:
+            return False
+        revision = self.revision(messages, title)
+        if self.saved_revisions.get(chat_id) == revision:
+            return False
+        if self.chat_manager.save_conversation(chat_id, messages, title):
+            self.saved_revisions[chat_id] = revision
+            return True
+        return False
@@ -0,0 +1,216 @@
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from search_index import tokenize
+
+
+def _feature(token, n_features):
+    """Stable signed column (+/-(column + 1)) for a token; crc32 rather than the per-process salted hash()"""
+    h = zlib.crc32(token.encode('utf-8'))
+    column = h % n_features + 1
+    return column if h >> 31 else -column
+
+
+class HashingEmbedder:
+    """Offline text embeddings: a hashing vectorizer followed by a fixed Gaussian random projection.
+
+    Word unigrams and bigrams are hashed into n_features signed columns with
+    sublinear (1 + log tf) weights, projected to dim dimensions and
+    L2-normalised, so dot products are cosine similarities. Everything is
+    derived from the seed, so vectors are stable across processes; bump
+    MODEL_VERSION whenever the recipe changes. Instances can also be passed to
+    ChromaDB as an embedding_function.
+    """
+
+    MODEL_VERSION = "hashing-rp-v1"
+
+    def __init__(self, dim=256, n_features=1 << 14, seed=0):
+        self.dim = dim
+        self.n_features = n_features
+        self.seed = seed
+        self.version = f"{self.MODEL_VERSION}-{dim}-{n_features}-{seed}"
+        self._projection = None
+        self._lock = threading.Lock()
+
+    @property
+    def projection(self):
+        with self._lock:
+            if self._projection is None:
+                rng = np.random.default_rng(self.seed)
+                self._projection = (rng.standard_normal((self.n_features, self.dim), dtype=np.float32)
+                                    / np.float32(np.sqrt(self.dim)))
+            return self._projection
+
+    def features(self, text):
+        """Hashed, signed, sublinearly weighted feature columns of a text"""
+        tokens = tokenize(text)
+        counts = Counter(tokens)
+        counts.update(map(" ".join, zip(tokens, tokens[1:])))
+        n_features = self.n_features
+        signed = np.array([_feature(gram, n_features) for gram in counts], dtype=np.int64)
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        return np.abs(signed) - 1, np.sign(signed).astype(np.float32) * (1 + np.log(tf))
+
+    def embed(self, texts):
+        """float32 array of shape (len(texts), dim) with unit-length rows (zero rows for empty texts)"""
+        texts = list(texts)
+        projection = self.projection
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            columns, weights = self.features(text)
+            if len(columns):
+                # Sparse row times the projection: only the rows of the hashed features
+                vectors[row] = weights @ projection[columns]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def __call__(self, input):
+        # ChromaDB EmbeddingFunction protocol
+        return self.embed(input).tolist()
+
+
+class EmbeddingCache:
+    """Persistent vector cache keyed by sha1(model version + whitespace-normalised text).
+
+    Backed by SQLite so every session and process shares it. Least recently
+    used entries are evicted once more than max_entries are stored (each
+    costs about dim * 4 bytes). Recency updates from cache hits are buffered
+    and written with the next insert or at exit.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            last_used INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used);
+    """
+
+    def __init__(self, path="embedding_cache.db", max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(self.SCHEMA)
+        # Upper bound on the entry count (replacements and other processes make it approximate)
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        atexit.register(self.close)
+
+    @staticmethod
+    def key(version, text):
+        normalized = " ".join(text.split())
+        return hashlib.sha1(f"{version}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """{key: float32 vector} for the cached keys"""
+        found = {}
+        unique = list(set(keys))
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            now = time.time_ns()
+            self._touched.update((key, now) for key in found)
+        return found
+
+    def put_many(self, items):
+        """Store (key, vector) pairs, then evict least recently used entries beyond max_entries"""
+        items = list(items)
+        now = time.time_ns()
+        with self._lock, self._conn:
+            self._write_touched()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+            )
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                excess = self._count - self.max_entries
+                if excess > 0:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+                    )
+                    self._count -= excess
+
+    def _write_touched(self):
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                   [(used, key) for key, used in self._touched.items()])
+            self._touched = {}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        """Write buffered recency updates"""
+        with self._lock:
+            try:
+                with self._conn:
+                    self._write_touched()
+            except sqlite3.ProgrammingError:
+                pass  # already closed
+
+
+class CachedEmbedder:
+    """Embedder wrapper that consults an EmbeddingCache first and embeds only the misses, in one batch"""
+
+    def __init__(self, embedder, cache):
+        self.embedder = embedder
+        self.cache = cache
+        self.dim = embedder.dim
+        self.version = embedder.version
+
+    def embed(self, texts):
+        texts = list(texts)
+        keys = [self.cache.key(self.version, text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embedder.embed(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self.cache.put_many(computed.items())
+            found.update(computed)
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, key in enumerate(keys):
+            result[row] = found[key]
+        return result
+
+    def __call__(self, input):
+        # ChromaDB EmbeddingFunction protocol
+        return self.embed(input).tolist()
+
+
+_default_embedders = {}
+
+
+def default_embedder(cache_path="embedding_cache.db"):
+    """Process-wide HashingEmbedder backed by the on-disk cache at cache_path (uncached if None)"""
+    if cache_path not in _default_embedders:
+        embedder = HashingEmbedder()
+        if cache_path is not None:
+            embedder = CachedEmbedder(embedder, EmbeddingCache(cache_path))
+        _default_embedders[cache_path] = embedder
+    return _default_embedders[cache_path]
@@ -0,0 +1,132 @@
+import re
+
+import numpy as np
+
+WORD = re.compile(r"\w+")
+NON_WORD = re.compile(r"\W+")
+
+# ASCII bytes outside \w map to spaces, which lets ASCII text skip the (much slower) regex pass
+_ASCII_WORDS = bytes(c if chr(c).isalnum() or c == ord('_') else ord(' ') for c in range(128)) + bytes(range(128, 256))
+
+# Odd 64-bit multiplier for the polynomial hashes (arithmetic wraps modulo 2**64)
+_HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+_BYTE_KEYS = np.random.default_rng(0x5EED).integers(1, 2 ** 63, size=256, dtype=np.uint64)
+
+
+def word_hashes(text):
+    """uint64 hash per lowercase \\w+ word of text, computed over the UTF-8 bytes without a Python-level loop"""
+    text = text.lower()
+    if text.isascii():
+        data = text.encode('ascii').translate(_ASCII_WORDS)
+    else:
+        data = NON_WORD.sub(' ', text).encode('utf-8')
+    data = np.frombuffer(data, dtype=np.uint8)
+    in_word = data != ord(' ')
+    positions = np.flatnonzero(in_word)
+    if not len(positions):
+        return np.zeros(0, dtype=np.uint64)
+    # A word starts wherever the next word byte is not adjacent to the previous one
+    starts = np.flatnonzero(np.diff(positions, prepend=-2) != 1)
+    offsets = np.arange(len(positions)) - np.repeat(starts, np.diff(starts, append=len(positions)))
+    powers = np.cumprod(np.full(offsets.max() + 1, _HASH_BASE, dtype=np.uint64))
+    return np.add.reduceat(_BYTE_KEYS[data[positions]] * powers[offsets], starts)
+
+
+def ngram_hashes(hashes, n):
+    """uint64 hash of every run of n consecutive words (empty if there are fewer than n words)"""
+    count = len(hashes) - n + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    result = hashes[:count].copy()
+    for offset in range(1, n):
+        result *= _HASH_BASE
+        result ^= hashes[offset:offset + count]
+    return result
+
+
+def _unique(hashes):
+    """Sorted distinct values (a plain sort plus a neighbour comparison beats np.unique here)"""
+    hashes = np.sort(hashes)
+    return hashes[np.concatenate(([True], hashes[1:] != hashes[:-1]))] if len(hashes) else hashes
+
+
+def _contains(sorted_unique, values):
+    """Boolean mask of which values occur in a sorted array of distinct values"""
+    if not len(sorted_unique):
+        return np.zeros(len(values), dtype=bool)
+    found = np.searchsorted(sorted_unique, values)
+    found[found == len(sorted_unique)] = 0
+    return sorted_unique[found] == values
+
+
+def _runs(mask):
+    """Lengths of the runs of consecutive True values in a boolean array"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return edges[1::2] - edges[::2]
+
+
+def winnow(text, k=5, window=4):
+    """MOSS-style winnowing fingerprints of text: (uint64 hashes, word positions).
+
+    Hashes every k-word shingle and keeps the rightmost minimum of each run of
+    window consecutive shingle hashes, so any passage of at least
+    k + window - 1 words shared by two texts yields a common fingerprint.
+    """
+    shingles = ngram_hashes(word_hashes(text), k)
+    if len(shingles) <= window:
+        if not len(shingles):
+            return shingles, np.zeros(0, dtype=np.int64)
+        position = len(shingles) - 1 - int(np.argmin(shingles[::-1]))
+        return shingles[position:position + 1], np.array([position], dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(shingles, window)
+    # argmin over each reversed window picks the rightmost minimum
+    positions = np.arange(len(windows)) + window - 1 - np.argmin(windows[:, ::-1], axis=1)
+    positions = positions[np.concatenate(([True], positions[1:] != positions[:-1]))]
+    return shingles[positions], positions
+
+
+def word_spans(text):
+    """Character (start, end) in text.lower() of each word, numbered as word_hashes and winnow number them.
+
+    Lowercasing can change the length of the string ("İ" becomes two
+    characters), so the spans only index the original text when
+    len(text.lower()) == len(text).
+    """
+    return [match.span() for match in WORD.finditer(text.lower())]
+
+
+def originality_report(source, output, n=3, shingle_size=5):
+    """How much of source survives in output, measured on hashed word n-grams.
+
+    ngram_overlap: share of the output's n-grams that also occur in the source.
+    shingle_jaccard: Jaccard similarity of the two texts' shingle_size-word shingle sets.
+    longest_copied_run: longest run of output words whose consecutive n-grams all
+    occur in the source, i.e. the longest (approximate) common word substring.
+    copied_fraction: share of output words covered by a shared n-gram.
+    originality: 1 - copied_fraction.
+    """
+    source_words = word_hashes(source)
+    output_words = word_hashes(output)
+
+    output_ngrams = ngram_hashes(output_words, n)
+    shared = _contains(_unique(ngram_hashes(source_words, n)), output_ngrams)
+
+    covered = np.zeros(len(output_words), dtype=bool)
+    for offset in range(n):
+        covered[offset:offset + len(shared)] |= shared
+    runs = _runs(shared)
+
+    source_shingles = _unique(ngram_hashes(source_words, shingle_size))
+    output_shingles = _unique(ngram_hashes(output_words, shingle_size))
+    common = int(_contains(source_shingles, output_shingles).sum())
+    union = len(source_shingles) + len(output_shingles) - common
+
+    copied_fraction = float(covered.mean()) if len(covered) else 0.0
+    return {
+        'ngram_overlap': round(float(shared.mean()) if len(shared) else 0.0, 3),
+        'shingle_jaccard': round(common / union if union else 0.0, 3),
+        'longest_copied_run': int(runs.max()) + n - 1 if len(runs) else 0,
+        'copied_fraction': round(copied_fraction, 3),
+        'originality': round(1 - copied_fraction, 3)
+    }
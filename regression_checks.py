@@ -0,0 +1,267 @@
+"""Regression checks for the storage and index crash/concurrency paths.
+
+Each check rebuilds a scenario that once lost or corrupted data, in a scratch
+directory, and raises AssertionError if it does again. Run from the
+repository root, e.g.:
+
+    python regression_checks.py
+    python regression_checks.py cached-writers --backend sqlite
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from benchmarks import make_conversation, storage_options
+from embeddings import HashingEmbedder
+from storage import JournalStorage, create_storage
+from vector_index import ChromaChunkStore, QuantizedVectorIndex
+
+
+def _uncached_writer(backend, options, saves, barrier):
+    storage = create_storage(backend, **options)
+    barrier.wait()
+    for i in range(saves):
+        storage.put(f"other{i}", make_conversation(f"other{i}"))
+
+
+def check_cached_writers(backend="sqlite", write_behind=False, saves=150):
+    """A cached process and an uncached one write at once; the cache must end up matching the store.
+
+    A cached write that read the signature after another process's write
+    adopted it as its own and kept serving a listing without that write.
+    """
+    workdir = tempfile.mkdtemp(prefix="history-check-")
+    try:
+        options = storage_options(backend, workdir)
+        cached = create_storage(backend, cache=True, write_behind=write_behind, **options)
+        cached.metadata()
+        barrier = multiprocessing.Barrier(2)
+        other = multiprocessing.Process(target=_uncached_writer, args=(backend, options, saves, barrier))
+        other.start()
+        barrier.wait()
+        for i in range(saves):
+            cached.put(f"mine{i}", make_conversation(f"mine{i}"))
+            cached.metadata()
+        other.join()
+        if write_behind:
+            cached.backend.flush()
+        seen = sorted(row['chat_id'] for row in cached.metadata())
+        stored = sorted(row['chat_id'] for row in create_storage(backend, **options).metadata())
+        assert seen == stored, f"cache lists {len(seen)} conversations, store holds {len(stored)}"
+        assert len(stored) == 2 * saves, f"{2 * saves - len(stored)} saves lost"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class _FlakyCollection(QuantizedVectorIndex):
+    """Local collection whose first `failures` upserts raise"""
+
+    def __init__(self, path, dim, failures=1):
+        super().__init__(path, dim)
+        self.failures = failures
+
+    def upsert(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("collection unavailable")
+        return super().upsert(*args, **kwargs)
+
+
+def _stored_chunks(store):
+    stored = store.collection.get()
+    return sorted(stored["ids"])
+
+
+def check_chunk_retry():
+    """A collection whose first upsert raises; the next save must still store every chunk.
+
+    Hashes used to be recorded before the upsert, so chunks that failed once
+    were treated as stored and never sent again while their text stayed the same.
+    """
+    workdir = tempfile.mkdtemp(prefix="chunks-check-")
+    try:
+        embedder = HashingEmbedder(dim=64)
+        store = ChromaChunkStore(_FlakyCollection(os.path.join(workdir, "chunks"), embedder.dim), embedder)
+        messages = make_conversation("a")["messages"]
+        try:
+            store.upsert_conversation("a", messages)
+            raise AssertionError("the failing upsert did not propagate")
+        except ConnectionError:
+            pass
+        assert not _stored_chunks(store), "chunks stored by a failed upsert"
+        store.upsert_conversation("a", messages)
+        assert len(_stored_chunks(store)) == len(messages), "failed chunks were not retried"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check_chunk_sessions(threads=8, saves=40):
+    """Several sessions save and delete chats through one shared store; it must stay consistent"""
+    workdir = tempfile.mkdtemp(prefix="chunks-check-")
+    try:
+        embedder = HashingEmbedder(dim=64)
+        store = ChromaChunkStore(QuantizedVectorIndex(os.path.join(workdir, "chunks"), embedder.dim), embedder,
+                                 batch_size=8)
+        errors = []
+
+        def session(worker):
+            try:
+                for i in range(saves):
+                    chat_id = f"c{(worker + i) % 10}"
+                    if i % 5 == 4:
+                        store.delete_conversation(chat_id)
+                    else:
+                        store.upsert_conversation(chat_id, make_conversation(chat_id, 1 + i % 7)["messages"])
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=session, args=(w,)) for w in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert not errors, f"sessions failed: {errors[0]!r}"
+        known = sorted(chunk_id for hashes in store.known.values() for chunk_id in hashes)
+        assert known == _stored_chunks(store), "known chunks differ from the collection"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _unit_vectors(row_ids, dim):
+    vectors = np.stack([np.random.default_rng(int(row_id[1:])).standard_normal(dim) for row_id in row_ids])
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _assert_rows(index, row_ids, dim):
+    """index holds exactly row_ids, each still finding its own vector"""
+    assert sorted(index.ids) == sorted(row_ids), f"{index.count()} rows, expected {len(row_ids)}"
+    for row_id, vector in zip(row_ids, _unit_vectors(row_ids, dim)):
+        found = index.query([vector], n_results=1)["ids"][0]
+        assert found == [row_id], f"{row_id} now points at the vector of {found}"
+
+
+def check_vector_crash(dim=16, saves=30):
+    """Reopen an int8 index after logged saves, and after a kill that follows an unsaved delete.
+
+    A delete moves the last vector into the hole; if the process dies before
+    the ids are saved, the old id table points at the wrong vectors, so the
+    index has to come back empty rather than answer with the wrong rows.
+    """
+    workdir = tempfile.mkdtemp(prefix="vectors-check-")
+    path = os.path.join(workdir, "vectors")
+    try:
+        index = QuantizedVectorIndex(path, dim)
+        index.COMPACT_MIN_CHANGES = 20  # exercise both logged saves and snapshot rewrites
+        live = []
+        for step in range(saves):
+            new = [f"r{step * 3 + i}" for i in range(3) if f"r{step * 3 + i}" not in live]
+            index.upsert(new, _unit_vectors(new, dim), metadatas=[{"chat_id": row_id} for row_id in new])
+            live.extend(new)
+            if step % 4 == 3:
+                index.delete(ids=live[::5])
+                del live[::5]
+            index.save()
+            if step % 7 == 6:
+                index = QuantizedVectorIndex(path, dim)
+                index.COMPACT_MIN_CHANGES = 20
+                _assert_rows(index, live, dim)
+        _assert_rows(QuantizedVectorIndex(path, dim), live, dim)
+
+        crash = (f"import os\nfrom vector_index import QuantizedVectorIndex\n"
+                 f"QuantizedVectorIndex({path!r}, {dim}).delete(ids=[{live[0]!r}])\nos._exit(0)\n")
+        subprocess.run([sys.executable, "-c", crash], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        index = QuantizedVectorIndex(path, dim)
+        assert index.count() == 0, "rows survived a crash that left the id table behind the vectors"
+        index.upsert(live[:2], _unit_vectors(live[:2], dim), metadatas=[{"chat_id": "x"}] * 2)
+        index.save()
+        _assert_rows(QuantizedVectorIndex(path, dim), live[:2], dim)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check_torn_journal():
+    """A writer dies mid-record; later appends and reopens must still read every complete record.
+
+    The next append used to land right after the partial bytes, and the merged
+    line then failed json.loads on every open.
+    """
+    workdir = tempfile.mkdtemp(prefix="journal-check-")
+    path = os.path.join(workdir, "history.jsonl")
+    try:
+        journal = JournalStorage(path, legacy_path=None)
+        journal.put("a", make_conversation("a"))
+        with open(path, 'ab') as f:
+            f.write(JournalStorage._encode({"op": "put", "chat_id": "torn", "data": {}}).encode()[:20])
+        journal.put("b", make_conversation("b"))
+        reopened = JournalStorage(path, legacy_path=None)
+        assert sorted(row['chat_id'] for row in reopened.metadata()) == ["a", "b"]
+
+        # A journal already damaged the old way: the partial record and the next one share a line
+        with open(path, 'ab') as f:
+            f.write(b'{"op":"put","chat_id":"torn","da')
+            f.write(JournalStorage._encode({"op": "delete", "chat_id": "a"}).encode())
+        reopened = JournalStorage(path, legacy_path=None)
+        assert [row['chat_id'] for row in reopened.metadata()] == ["b"], "merged record was not salvaged"
+        reopened.put("c", make_conversation("c"))
+        assert sorted(row['chat_id'] for row in JournalStorage(path, legacy_path=None).metadata()) == ["b", "c"]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_cached_writers(args):
+    for backend in args.backends:
+        for write_behind in (False, True):
+            check_cached_writers(backend, write_behind)
+            print(f"ok cached-writers {backend}{' write-behind' if write_behind else ''}")
+
+
+def run_chunk_retry(args):
+    check_chunk_retry()
+    print("ok chunk-retry")
+
+
+def run_chunk_sessions(args):
+    check_chunk_sessions()
+    print("ok chunk-sessions")
+
+
+def run_vector_crash(args):
+    check_vector_crash()
+    print("ok vector-crash")
+
+
+def run_torn_journal(args):
+    check_torn_journal()
+    print("ok torn-journal")
+
+
+CHECKS = {
+    "cached-writers": run_cached_writers,
+    "chunk-retry": run_chunk_retry,
+    "chunk-sessions": run_chunk_sessions,
+    "vector-crash": run_vector_crash,
+    "torn-journal": run_torn_journal,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("checks", nargs="*", help=f"checks to run (default: all of {', '.join(CHECKS)})")
+    parser.add_argument("--backend", default="all", choices=["all", "json", "journal", "sqlite", "sharded"])
+    args = parser.parse_args()
+    unknown = [check for check in args.checks if check not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(unknown)}")
+    args.backends = ["json", "journal", "sqlite", "sharded"] if args.backend == "all" else [args.backend]
+    for check in args.checks or CHECKS:
+        CHECKS[check](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,983 @@
+import atexit
+import bisect
+import heapq
+import math
+import os
+import hashlib
+import pickle
+import re
+import sqlite3
+import threading
+import uuid
+from array import array
+from collections import Counter, OrderedDict
+from io import BytesIO
+
+import numpy as np
+
+from originality import winnow, word_spans
+from storage import atomic_write_bytes, conversation_metadata, message_digests, timestamp_epoch
+from utils import AIResponseHandler
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercase word tokens"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def conversation_text(conversation):
+    """Title and message contents of a conversation as one searchable string"""
+    parts = [conversation.get('title', '')]
+    parts.extend(msg.get('content', '') for msg in conversation.get('messages', []))
+    return "\n".join(parts)
+
+
+def conversation_matches(conversation, query_lower):
+    """Substring match on title or any message, exactly as search_conversations defines it"""
+    if query_lower in conversation.get('title', '').lower():
+        return True
+    for msg in conversation.get('messages', []):
+        if query_lower in msg.get('content', '').lower():
+            return True
+    return False
+
+
+class KeywordMatcher:
+    """Finds which of several keywords occur in a conversation in one regex pass per text.
+
+    The pattern is a lookahead alternation tried at every position with longer
+    keywords first, so each position reports the longest keyword starting
+    there. A keyword hidden that way is a prefix of a reported one, which is
+    why match() also credits keywords contained in the reported ones.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = sorted({keyword.strip().lower() for keyword in keywords if keyword.strip()},
+                               key=len, reverse=True)
+        alternation = "|".join(re.escape(keyword) for keyword in self.keywords)
+        self.pattern = re.compile(f"(?=({alternation}))") if self.keywords else None
+
+    def match(self, conversation):
+        """Set of keywords found in the title or any message"""
+        if self.pattern is None:
+            return set()
+        found = set()
+        texts = [conversation.get('title', '')]
+        texts.extend(msg.get('content', '') for msg in conversation.get('messages', []))
+        for text in texts:
+            found.update(self.pattern.findall(text.lower()))
+            if len(found) == len(self.keywords):
+                return found
+        found.update(keyword for keyword in self.keywords
+                     if keyword not in found and any(keyword in other for other in found))
+        return found
+
+
+def trigrams(text):
+    """Set of 3-character substrings of text"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def bounded_levenshtein(a, b, max_distance):
+    """Edit distance between a and b, or None once it must exceed max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse {signal: [(chat_id, score), ...] best first} into [(chat_id, fused score, {signal: (rank, score)})].
+
+    Each list contributes 1 / (k + rank) per chat (ranks start at 1), so only
+    positions matter and signals on different scales combine without tuning.
+    """
+    fused = {}
+    signals = {}
+    for signal, ranking in rankings.items():
+        for rank, (chat_id, score) in enumerate(ranking, 1):
+            fused[chat_id] = fused.get(chat_id, 0.0) + 1 / (k + rank)
+            signals.setdefault(chat_id, {})[signal] = (rank, score)
+    return [(chat_id, score, signals[chat_id])
+            for chat_id, score in sorted(fused.items(), key=lambda item: item[1], reverse=True)]
+
+
+class ConversationIndex:
+    """Base class for derived search structures kept in step with a storage backend.
+
+    The index file is only a warm-start cache: on first use and whenever the
+    storage signature changes, sync() compares each conversation's timestamp
+    with the version it was indexed at and re-indexes only the differences.
+    The manager also calls add/remove on every save and delete. The file is
+    rewritten after a sync that re-indexed at least SAVE_EVERY conversations
+    and at interpreter exit. It is a pickle written by this process, so keep
+    it next to the history it was built from.
+    """
+
+    SAVE_EVERY = 1000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.versions = {}
+        self.rows = {}
+        self._lock = threading.RLock()
+        self._signature = None
+        self._pending_updates = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    state = pickle.load(f)
+                self.versions = state["versions"]
+                self.rows = state["rows"]
+                self._restore(state)
+            except (pickle.UnpicklingError, EOFError, KeyError, AttributeError, ValueError):
+                # Unreadable cache: start empty and let sync() rebuild it
+                self.versions, self.rows = {}, {}
+                self._restore(None)
+        else:
+            self._restore(None)
+        if path:
+            atexit.register(self.save)
+
+    # Subclasses implement the actual structure
+    def _restore(self, state):
+        raise NotImplementedError
+
+    def _state(self):
+        raise NotImplementedError
+
+    def _index_document(self, chat_id, conversation):
+        raise NotImplementedError
+
+    def _unindex_document(self, chat_id):
+        raise NotImplementedError
+
+    # Indexes that can update a document in place override this
+    def _reindex_document(self, chat_id, conversation):
+        self._unindex_document(chat_id)
+        self._index_document(chat_id, conversation)
+
+    def _add(self, chat_id, conversation):
+        if chat_id in self.versions:
+            self._reindex_document(chat_id, conversation)
+        else:
+            self._index_document(chat_id, conversation)
+        self.versions[chat_id] = conversation.get('timestamp', '')
+        self.rows[chat_id] = conversation_metadata(chat_id, conversation)
+        self._pending_updates += 1
+
+    def _remove(self, chat_id):
+        if chat_id in self.versions:
+            self._unindex_document(chat_id)
+            del self.versions[chat_id]
+            del self.rows[chat_id]
+            self._pending_updates += 1
+
+    def add(self, chat_id, conversation):
+        """Index (or re-index) a conversation"""
+        with self._lock:
+            self._add(chat_id, conversation)
+
+    def remove(self, chat_id):
+        """Drop a conversation from the index"""
+        with self._lock:
+            self._remove(chat_id)
+
+    def sync(self, storage):
+        """Bring the index up to date with storage if the storage changed since the last sync"""
+        signature = storage.signature() if hasattr(storage, "signature") else None
+        with self._lock:
+            if signature is not None and signature == self._signature:
+                return
+            current = {row['chat_id']: row['timestamp'] for row in storage.metadata()}
+            for chat_id in [chat_id for chat_id in self.versions if chat_id not in current]:
+                self._remove(chat_id)
+            for chat_id, timestamp in current.items():
+                if self.versions.get(chat_id) != timestamp:
+                    conversation = storage.get(chat_id)
+                    if conversation is not None:
+                        self._add(chat_id, conversation)
+            self._signature = signature
+            if self._pending_updates >= self.SAVE_EVERY:
+                self.save()
+
+    def save(self):
+        """Persist the index if it changed since the last save"""
+        with self._lock:
+            if not self.path or not self._pending_updates:
+                return
+            state = self._state()
+            state["versions"] = self.versions
+            state["rows"] = self.rows
+            atomic_write_bytes(self.path, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+            self._pending_updates = 0
+
+
+class BM25Index(ConversationIndex):
+    """Inverted index (token -> {chat_id: term frequency}) ranked with Okapi BM25"""
+
+    def __init__(self, path=None, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        super().__init__(path)
+
+    def _restore(self, state):
+        self.postings = state["postings"] if state else {}
+        self.doc_terms = state["doc_terms"] if state else {}
+        self.doc_lengths = state["doc_lengths"] if state else {}
+        self.total_length = sum(self.doc_lengths.values())
+
+    def _state(self):
+        return {"postings": self.postings, "doc_terms": self.doc_terms, "doc_lengths": self.doc_lengths}
+
+    def _index_document(self, chat_id, conversation):
+        counts = Counter(tokenize(conversation_text(conversation)))
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {})[chat_id] = tf
+        self.doc_terms[chat_id] = list(counts)
+        length = sum(counts.values())
+        self.doc_lengths[chat_id] = length
+        self.total_length += length
+
+    def _unindex_document(self, chat_id):
+        for token in self.doc_terms.pop(chat_id, []):
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(chat_id, None)
+                if not postings:
+                    del self.postings[token]
+        self.total_length -= self.doc_lengths.pop(chat_id, 0)
+
+    def search(self, query, n_results=10):
+        """Return [(chat_id, score)] for the best BM25 matches, highest score first"""
+        with self._lock:
+            n_docs = len(self.doc_lengths)
+            if not n_docs:
+                return []
+            avg_length = self.total_length / n_docs or 1
+            scores = {}
+            for token in set(tokenize(query)):
+                postings = self.postings.get(token)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                k1, b = self.k1, self.b
+                for chat_id, tf in postings.items():
+                    norm = k1 * (1 - b + b * self.doc_lengths[chat_id] / avg_length)
+                    scores[chat_id] = scores.get(chat_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+            return heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+
+
+class TrigramIndex(ConversationIndex):
+    """Trigram -> sorted doc-number postings used to prefilter substring search.
+
+    A conversation containing the query as a substring must contain every
+    trigram of the query, so intersecting those postings yields a candidate
+    set that is then verified with the exact substring test. Postings are
+    append-only uint32 arrays; removed or re-indexed documents become
+    tombstones until a compaction renumbers the survivors.
+    """
+
+    def _restore(self, state):
+        self.postings = state["postings"] if state else {}
+        self.chat_ids = state["chat_ids"] if state else []
+        self.doc_numbers = {chat_id: number for number, chat_id in enumerate(self.chat_ids)
+                            if chat_id is not None}
+        self.dead = len(self.chat_ids) - len(self.doc_numbers)
+
+    def _state(self):
+        return {"postings": self.postings, "chat_ids": self.chat_ids}
+
+    def _index_document(self, chat_id, conversation):
+        number = len(self.chat_ids)
+        self.chat_ids.append(chat_id)
+        self.doc_numbers[chat_id] = number
+        grams = trigrams(conversation.get('title', '').lower())
+        for msg in conversation.get('messages', []):
+            grams |= trigrams(msg.get('content', '').lower())
+        index = self.postings
+        for gram in grams:
+            postings = index.get(gram)
+            if postings is None:
+                postings = index[gram] = array('I')
+            postings.append(number)
+
+    def _unindex_document(self, chat_id):
+        number = self.doc_numbers.pop(chat_id)
+        self.chat_ids[number] = None
+        self.dead += 1
+        if self.dead > 1000 and self.dead > len(self.doc_numbers):
+            self.compact()
+
+    def compact(self):
+        """Drop tombstoned documents from every posting list and renumber the rest"""
+        with self._lock:
+            alive = np.array([chat_id is not None for chat_id in self.chat_ids], dtype=bool)
+            remap = np.where(alive, np.cumsum(alive) - 1, -1).astype(np.int64)
+            for gram, postings in list(self.postings.items()):
+                numbers = remap[np.frombuffer(postings, dtype=np.uint32)]
+                numbers = numbers[numbers >= 0]
+                if len(numbers):
+                    self.postings[gram] = array('I', numbers.astype(np.uint32).tobytes())
+                else:
+                    del self.postings[gram]
+            self.chat_ids = [chat_id for chat_id in self.chat_ids if chat_id is not None]
+            self.doc_numbers = {chat_id: number for number, chat_id in enumerate(self.chat_ids)}
+            self.dead = 0
+            self._pending_updates += 1
+
+    def candidates(self, query_lower):
+        """chat_ids that may contain query_lower, or None when the query is too short to filter"""
+        grams = trigrams(query_lower)
+        if not grams:
+            return None
+        with self._lock:
+            lists = []
+            for gram in grams:
+                postings = self.postings.get(gram)
+                if postings is None:
+                    return []
+                lists.append(postings)
+            lists.sort(key=len)
+            numbers = np.frombuffer(lists[0], dtype=np.uint32)
+            for postings in lists[1:]:
+                if not len(numbers):
+                    break
+                numbers = np.intersect1d(numbers, np.frombuffer(postings, dtype=np.uint32), assume_unique=True)
+            return [chat_id for chat_id in (self.chat_ids[number] for number in numbers.tolist())
+                    if chat_id is not None]
+
+    def keyword_candidates(self, keywords, match="any"):
+        """chat_ids that may contain any (or all) of the lowercased keywords, or None if no filtering is possible"""
+        sets = [self.candidates(keyword) for keyword in keywords]
+        if match == "all":
+            sets = [set(chat_ids) for chat_ids in sets if chat_ids is not None]
+            return list(set.intersection(*sets)) if sets else None
+        if any(chat_ids is None for chat_ids in sets):
+            return None
+        return list(set().union(*sets))
+
+    def search(self, query, n_results, storage):
+        """Newest-first substring matches, verifying trigram candidates against storage"""
+        query_lower = query.lower()
+        with self._lock:
+            candidates = self.candidates(query_lower)
+            if candidates is None:
+                candidates = list(self.rows)
+            rows = sorted((self.rows[chat_id] for chat_id in candidates),
+                          key=lambda row: row['timestamp'], reverse=True)
+        results = []
+        for row in rows:
+            conversation = storage.get(row['chat_id'])
+            if conversation is not None and conversation_matches(conversation, query_lower):
+                results.append(row)
+                if len(results) == n_results:
+                    break
+        return results
+
+
+class MetadataTable(ConversationIndex):
+    """Columnar metadata (epoch, message_count, characters, content_type) for vectorized filters.
+
+    Rows live in one NumPy structured array, row i belonging to chat_ids[i];
+    deletes move the last row into the hole. Each save writes the array to a
+    fresh .npy file next to the index and the pickle points at it, so a cold
+    start memory-maps the columns instead of rebuilding them. The mapping is
+    read-only and is copied into memory on the first change.
+    """
+
+    DTYPE = np.dtype([("epoch", "i8"), ("message_count", "i4"), ("characters", "i8"), ("content_type", "i1")])
+    CONTENT_TYPES = ("general", "rewrite", "summarize", "explain", "translate", "improve")
+    SORT_KEYS = {
+        "newest": ("epoch", True),
+        "oldest": ("epoch", False),
+        "messages": ("message_count", True),
+        "characters": ("characters", True)
+    }
+
+    def _restore(self, state):
+        self.table_file = state["table_file"] if state else None
+        self.chat_ids = state["chat_ids"] if state else []
+        self.table = np.zeros(0, dtype=self.DTYPE)
+        if self.table_file:
+            try:
+                self.table = np.load(self._table_path(self.table_file), mmap_mode='r')
+            except OSError as e:
+                raise ValueError(f"missing metadata columns: {e}")
+            if self.table.dtype != self.DTYPE or len(self.table) != len(self.chat_ids):
+                raise ValueError("metadata columns do not match the index")
+        self.positions = {chat_id: i for i, chat_id in enumerate(self.chat_ids)}
+
+    def _state(self):
+        return {"chat_ids": self.chat_ids, "table_file": self.table_file}
+
+    def _table_path(self, name):
+        return os.path.join(os.path.dirname(self.path) or ".", name)
+
+    def _writable(self, capacity):
+        size = len(self.chat_ids)
+        if self.table.flags.writeable and len(self.table) >= capacity:
+            return
+        table = np.zeros(max(1024, capacity, 2 * len(self.table)), dtype=self.DTYPE)
+        table[:size] = self.table[:size]
+        self.table = table
+
+    @classmethod
+    def content_type(cls, conversation):
+        """Content-type code of the first user message"""
+        for msg in conversation.get('messages', []):
+            if msg.get('role') == 'user':
+                return cls.CONTENT_TYPES.index(AIResponseHandler.detect_content_type(msg.get('content', '')))
+        return 0
+
+    def _index_document(self, chat_id, conversation):
+        position = len(self.chat_ids)
+        self._writable(position + 1)
+        messages = conversation.get('messages', [])
+        self.table[position] = (
+            timestamp_epoch(conversation.get('timestamp', '')),
+            len(messages),
+            sum(len(msg.get('content', '')) for msg in messages),
+            self.content_type(conversation)
+        )
+        self.chat_ids.append(chat_id)
+        self.positions[chat_id] = position
+
+    def _unindex_document(self, chat_id):
+        self._writable(len(self.chat_ids))
+        position = self.positions.pop(chat_id)
+        last = len(self.chat_ids) - 1
+        if position != last:
+            self.table[position] = self.table[last]
+            self.chat_ids[position] = self.chat_ids[last]
+            self.positions[self.chat_ids[position]] = position
+        self.chat_ids.pop()
+
+    def save(self):
+        """Write the columns to a new .npy file, then the index pointing at it"""
+        with self._lock:
+            if not self.path or not self._pending_updates:
+                return
+            previous = self.table_file
+            self.table_file = f"{os.path.basename(self.path)}.{uuid.uuid4().hex[:12]}.npy"
+            buffer = BytesIO()
+            np.save(buffer, np.ascontiguousarray(self.table[:len(self.chat_ids)]))
+            atomic_write_bytes(self._table_path(self.table_file), buffer.getvalue())
+            super().save()
+            if previous:
+                try:
+                    os.remove(self._table_path(previous))
+                except FileNotFoundError:
+                    pass
+
+    def query(self, start_epoch=None, end_epoch=None, min_messages=None, max_messages=None,
+              min_characters=None, max_characters=None, content_types=None, sort_by="newest", limit=None):
+        """Metadata rows passing every given filter ([start_epoch, end_epoch), inclusive counts), sorted by sort_by"""
+        with self._lock:
+            columns = self.table[:len(self.chat_ids)]
+            mask = np.ones(len(columns), dtype=bool)
+            if start_epoch is not None:
+                mask &= columns["epoch"] >= start_epoch
+            if end_epoch is not None:
+                mask &= columns["epoch"] < end_epoch
+            if min_messages is not None:
+                mask &= columns["message_count"] >= min_messages
+            if max_messages is not None:
+                mask &= columns["message_count"] <= max_messages
+            if min_characters is not None:
+                mask &= columns["characters"] >= min_characters
+            if max_characters is not None:
+                mask &= columns["characters"] <= max_characters
+            if content_types:
+                codes = [self.CONTENT_TYPES.index(name) for name in content_types]
+                mask &= np.isin(columns["content_type"], codes)
+
+            positions = np.flatnonzero(mask)
+            field, descending = self.SORT_KEYS[sort_by]
+            selected = columns[positions]
+            order = np.lexsort((selected["epoch"], selected[field]))
+            if descending:
+                order = order[::-1]
+            if limit is not None:
+                order = order[:limit]
+            return [self.rows[self.chat_ids[position]] for position in positions[order].tolist()]
+
+
+class FuzzyTitleIndex(ConversationIndex):
+    """Typo-tolerant title search: padded-trigram index over the title vocabulary.
+
+    A query word finds vocabulary words sharing enough trigrams to be within
+    the edit budget (one edit changes at most three of them), which are then
+    checked with a bounded Levenshtein distance. Matching words map back to
+    the chats whose titles contain them.
+    """
+
+    def _restore(self, state):
+        self.word_chats = state["word_chats"] if state else {}
+        self.doc_words = state["doc_words"] if state else {}
+        self.gram_words = {}
+        for word in self.word_chats:
+            self._add_word_grams(word)
+
+    def _state(self):
+        return {"word_chats": self.word_chats, "doc_words": self.doc_words}
+
+    @staticmethod
+    def word_grams(word):
+        padded = f"$${word}$$"
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _add_word_grams(self, word):
+        for gram in self.word_grams(word):
+            self.gram_words.setdefault(gram, set()).add(word)
+
+    def _index_document(self, chat_id, conversation):
+        words = set(tokenize(conversation.get('title', '')))
+        self.doc_words[chat_id] = list(words)
+        for word in words:
+            chats = self.word_chats.get(word)
+            if chats is None:
+                chats = self.word_chats[word] = set()
+                self._add_word_grams(word)
+            chats.add(chat_id)
+
+    def _unindex_document(self, chat_id):
+        for word in self.doc_words.pop(chat_id, []):
+            chats = self.word_chats.get(word)
+            if chats is None:
+                continue
+            chats.discard(chat_id)
+            if not chats:
+                del self.word_chats[word]
+                for gram in self.word_grams(word):
+                    words = self.gram_words.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self.gram_words[gram]
+
+    @staticmethod
+    def default_distance(word):
+        return 0 if len(word) < 3 else 1 if len(word) <= 5 else 2
+
+    def similar_words(self, term, max_distance=None):
+        """[(word, distance)] for vocabulary words within max_distance edits of term"""
+        if max_distance is None:
+            max_distance = self.default_distance(term)
+        if max_distance == 0:
+            return [(term, 0)] if term in self.word_chats else []
+        grams = self.word_grams(term)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.gram_words.get(gram, ()))
+        needed = max(1, len(grams) - 3 * max_distance)
+        similar = []
+        for word, count in shared.items():
+            if count >= needed:
+                distance = bounded_levenshtein(term, word, max_distance)
+                if distance is not None:
+                    similar.append((word, distance))
+        return similar
+
+    def search(self, query, n_results=10, max_distance=None):
+        """Title matches tolerant of typos, as metadata rows with a score.
+
+        A row's score adds, for each query word, the best similarity
+        (1 - distance / length) among its title words; rows matching more
+        query words rank first, then higher scores, then newer chats.
+        """
+        with self._lock:
+            totals = {}
+            for term in set(tokenize(query)):
+                best = {}
+                for word, distance in self.similar_words(term, max_distance):
+                    similarity = 1 - distance / max(len(term), len(word))
+                    for chat_id in self.word_chats[word]:
+                        if similarity > best.get(chat_id, 0):
+                            best[chat_id] = similarity
+                for chat_id, similarity in best.items():
+                    matched, score = totals.get(chat_id, (0, 0.0))
+                    totals[chat_id] = (matched + 1, score + similarity)
+            ranked = heapq.nlargest(n_results, totals.items(),
+                                    key=lambda item: (item[1], self.rows[item[0]]['timestamp']))
+            return [dict(self.rows[chat_id], score=round(score, 3)) for chat_id, (_, score) in ranked]
+
+
+class PrefixIndex(ConversationIndex):
+    """Search-as-you-type: every query word matches indexed words it is a prefix of.
+
+    The vocabulary is kept as a sorted list, a flattened trie in which a
+    prefix's words form one bisect range. Each chat keeps its sorted words, so
+    checking a prefix against one chat is also a bisect. Candidate sets are
+    cached (LRU) per generation, which changes with every indexed save or
+    delete; a query that extends a cached one (the next keystroke) filters
+    that candidate set instead of starting from the postings.
+    """
+
+    CACHE_SIZE = 128
+
+    def _restore(self, state):
+        self.word_chats = state["word_chats"] if state else {}
+        self.doc_words = state["doc_words"] if state else {}
+        self.terms = sorted(self.word_chats)
+        self.generation = 0
+        self.cache = OrderedDict()
+
+    def _state(self):
+        return {"word_chats": self.word_chats, "doc_words": self.doc_words}
+
+    def _index_document(self, chat_id, conversation):
+        words = sorted(set(tokenize(conversation_text(conversation))))
+        self.doc_words[chat_id] = words
+        for word in words:
+            chats = self.word_chats.get(word)
+            if chats is None:
+                chats = self.word_chats[word] = set()
+                bisect.insort(self.terms, word)
+            chats.add(chat_id)
+        self.generation += 1
+
+    def _unindex_document(self, chat_id):
+        for word in self.doc_words.pop(chat_id, []):
+            chats = self.word_chats.get(word)
+            if chats is None:
+                continue
+            chats.discard(chat_id)
+            if not chats:
+                del self.word_chats[word]
+                del self.terms[bisect.bisect_left(self.terms, word)]
+        self.generation += 1
+
+    def words_with_prefix(self, prefix):
+        """Indexed words starting with prefix, in sorted order"""
+        start = bisect.bisect_left(self.terms, prefix)
+        return self.terms[start:bisect.bisect_left(self.terms, prefix + "\U0010ffff", start)]
+
+    @staticmethod
+    def _has_prefix(words, prefix):
+        position = bisect.bisect_left(words, prefix)
+        return position < len(words) and words[position].startswith(prefix)
+
+    def _refine(self, candidates, prefixes):
+        for prefix in prefixes:
+            postings = [self.word_chats[word] for word in self.words_with_prefix(prefix)]
+            if sum(map(len, postings)) < len(candidates):
+                # Fewer postings than candidates: intersecting is cheaper than filtering
+                candidates = candidates.intersection(set().union(*postings))
+            else:
+                candidates = {chat_id for chat_id in candidates
+                              if self._has_prefix(self.doc_words[chat_id], prefix)}
+        return candidates
+
+    def _cached_base(self, prefixes):
+        """Smallest cached candidate set for a query this one extends, with the prefixes left to check"""
+        best = None
+        for (generation, cached), candidates in self.cache.items():
+            n = len(cached)
+            if (generation == self.generation and n <= len(prefixes) and cached[:n - 1] == prefixes[:n - 1]
+                    and prefixes[n - 1].startswith(cached[n - 1])
+                    and (best is None or len(candidates) < len(best[0]))):
+                best = (candidates, prefixes[n - 1:] if prefixes[n - 1] != cached[n - 1] else prefixes[n:])
+        return best
+
+    def candidates(self, query):
+        """Set of chat_ids having, for every query word, a word that starts with it"""
+        prefixes = tuple(tokenize(query))
+        if not prefixes:
+            return set()
+        with self._lock:
+            key = (self.generation, prefixes)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            base = self._cached_base(prefixes)
+            if base is None:
+                # Start from the longest prefix (usually the fewest postings) and refine by the rest
+                start = max(prefixes, key=len)
+                postings = [self.word_chats[word] for word in self.words_with_prefix(start)]
+                base = (set().union(*postings), [prefix for prefix in prefixes if prefix != start])
+            candidates = self._refine(*base)
+
+            self.cache[key] = candidates
+            for stale in [k for k in self.cache if k[0] != self.generation]:
+                del self.cache[stale]
+            while len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return candidates
+
+    def search(self, query, n_results=10):
+        """Newest-first metadata rows for chats matching every word prefix in query"""
+        with self._lock:
+            candidates = self.candidates(query)
+            return heapq.nlargest(n_results, (self.rows[chat_id] for chat_id in candidates),
+                                  key=lambda row: row['timestamp'])
+
+
+class FingerprintIndex(ConversationIndex):
+    """Winnowing fingerprints of every stored message, plus optional reference texts, for plagiarism checks.
+
+    Fingerprints live in a SQLite table clustered on the hash (<index>.db), so
+    a check costs one lookup per fingerprint of the checked text however large
+    the corpus grows. Each message is a document of its own; reference texts
+    added with add_reference are kept across rebuilds. The first change after
+    a save bumps a generation counter in the database and save() records the
+    counter in the pickle, so after a crash the mismatch makes sync() rebuild
+    the history part instead of trusting stale versions. Each chat also keeps
+    a digest of the messages it was indexed with, so a save that only appends
+    messages fingerprints just the new ones.
+    """
+
+    K = 5
+    WINDOW = 4
+    MAX_POSTINGS = 1000  # fingerprints shared by more documents are boilerplate and skipped
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            doc INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            version TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_documents_name ON documents(source, name);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            hash INTEGER NOT NULL,
+            doc INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (hash, doc, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_fingerprints_doc ON fingerprints(doc);
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            digest TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+    """
+
+    def __init__(self, path=None):
+        self.db_path = f"{path}.db" if path else ":memory:"
+        self._conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(self.SCHEMA)
+        self._dirty = False
+        super().__init__(path)
+
+    def _generation(self):
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def _bump_generation(self):
+        self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def _changing(self):
+        if not self._dirty:
+            self._bump_generation()
+            self._dirty = True
+
+    def _restore(self, state):
+        if state is not None and state.get("generation") != self._generation():
+            raise ValueError("fingerprint database changed after the index was saved")
+        if state is None:
+            with self._conn:
+                self._conn.execute("DELETE FROM fingerprints WHERE doc IN "
+                                   "(SELECT doc FROM documents WHERE source = 'history')")
+                self._conn.execute("DELETE FROM documents WHERE source = 'history'")
+                self._conn.execute("DELETE FROM chats")
+                self._bump_generation()
+
+    def _state(self):
+        with self._conn:
+            self._bump_generation()
+        self._dirty = False
+        return {"generation": self._generation()}
+
+    def _insert_document(self, source, name, position, role, text, version=''):
+        hashes, offsets = winnow(text, self.K, self.WINDOW)
+        if not len(hashes):
+            return
+        doc = self._conn.execute(
+            "INSERT INTO documents (source, name, position, role, version) VALUES (?, ?, ?, ?, ?)",
+            (source, name, position, role, version)
+        ).lastrowid
+        # SQLite integers are signed 64-bit
+        self._conn.executemany("INSERT OR IGNORE INTO fingerprints (hash, doc, position) VALUES (?, ?, ?)",
+                               [(h, doc, offset) for h, offset
+                                in zip(hashes.view(np.int64).tolist(), offsets.tolist())])
+
+    def _delete_documents(self, source, name):
+        docs = self._conn.execute("SELECT doc FROM documents WHERE source = ? AND name = ?",
+                                  (source, name)).fetchall()
+        self._conn.executemany("DELETE FROM fingerprints WHERE doc = ?", docs)
+        self._conn.execute("DELETE FROM documents WHERE source = ? AND name = ?", (source, name))
+
+    def _index_document(self, chat_id, conversation):
+        messages = conversation.get('messages', [])
+        stored = self._conn.execute("SELECT message_count, digest FROM chats WHERE chat_id = ?",
+                                    (chat_id,)).fetchone()
+        count, stored_digest = stored if stored else (0, None)
+        prefix_digest, digest = message_digests(messages, count)
+        if digest == stored_digest:
+            return
+        self._changing()
+        if not count or prefix_digest != stored_digest:
+            # Earlier messages changed (or the chat is new): fingerprint it from scratch
+            self._delete_documents("history", chat_id)
+            count = 0
+        for position in range(count, len(messages)):
+            msg = messages[position]
+            self._insert_document("history", chat_id, position, msg.get('role', ''), msg.get('content', ''))
+        self._conn.execute("INSERT OR REPLACE INTO chats (chat_id, message_count, digest) VALUES (?, ?, ?)",
+                           (chat_id, len(messages), digest))
+
+    def _reindex_document(self, chat_id, conversation):
+        self._index_document(chat_id, conversation)
+
+    def _unindex_document(self, chat_id):
+        self._changing()
+        self._delete_documents("history", chat_id)
+        self._conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+
+    def add(self, chat_id, conversation):
+        with self._lock, self._conn:
+            super().add(chat_id, conversation)
+
+    def remove(self, chat_id):
+        with self._lock, self._conn:
+            super().remove(chat_id)
+
+    def sync(self, storage):
+        with self._lock, self._conn:
+            super().sync(storage)
+
+    def add_reference(self, name, text):
+        """Index (or replace) a reference text; returns False if it is already indexed unchanged"""
+        version = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock, self._conn:
+            stored = self._conn.execute("SELECT version FROM documents WHERE source = 'reference' AND name = ?",
+                                        (name,)).fetchone()
+            if stored is not None and stored[0] == version:
+                return False
+            self._changing()
+            self._delete_documents("reference", name)
+            self._insert_document("reference", name, 0, '', text, version)
+            self._pending_updates += 1
+            return True
+
+    def remove_reference(self, name):
+        """Drop a reference text"""
+        with self._lock, self._conn:
+            self._changing()
+            self._delete_documents("reference", name)
+            self._pending_updates += 1
+
+    @staticmethod
+    def _spans(pairs, k, gap):
+        """Merge (query position, document position) fingerprint hits that advance together into passages"""
+        spans = []
+        for query_position, doc_position in sorted(pairs):
+            if spans:
+                span = spans[-1]
+                if 0 <= query_position - span[1] <= gap and 0 <= doc_position - span[3] <= gap:
+                    span[1], span[3] = query_position, doc_position
+                    continue
+            spans.append([query_position, query_position, doc_position, doc_position])
+        return [(qs, qe + k, ds, de + k) for qs, qe, ds, de in spans]
+
+    def check(self, text, limit=10, exclude_chat_id=None):
+        """Indexed documents sharing passages with text, most shared fingerprints first.
+
+        Rows carry source ("history" or "reference"), name (chat_id or reference
+        name), message position and role, the number and share of the text's
+        fingerprints found in the document, and the shared passages as word
+        ranges of the text (with its excerpt) and of the document.
+        """
+        hashes, offsets = winnow(text, self.K, self.WINDOW)
+        if not len(hashes):
+            return []
+        query_offsets = {}
+        for h, offset in zip(hashes.view(np.int64).tolist(), offsets.tolist()):
+            query_offsets.setdefault(h, []).append(offset)
+
+        postings = {}
+        with self._lock:
+            keys = list(query_offsets)
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                for h, doc, position in self._conn.execute(
+                        f"SELECT hash, doc, position FROM fingerprints WHERE hash IN ({', '.join('?' * len(batch))})",
+                        batch):
+                    postings.setdefault(h, []).append((doc, position))
+            excluded = set()
+            if exclude_chat_id is not None:
+                excluded = {doc for doc, in self._conn.execute(
+                    "SELECT doc FROM documents WHERE source = 'history' AND name = ?", (exclude_chat_id,))}
+            hits = {}
+            for h, entries in postings.items():
+                if len(entries) > self.MAX_POSTINGS:
+                    continue
+                for doc, position in entries:
+                    if doc in excluded:
+                        continue
+                    hit = hits.setdefault(doc, ([], set()))
+                    hit[0].extend((offset, position) for offset in query_offsets[h])
+                    hit[1].add(h)
+            ranked = heapq.nlargest(limit, hits.items(), key=lambda item: len(item[1][1]))
+            documents = {}
+            docs = [doc for doc, _ in ranked]
+            if docs:
+                documents = {row[0]: row[1:] for row in self._conn.execute(
+                    f"SELECT doc, source, name, position, role FROM documents WHERE doc IN ({', '.join('?' * len(docs))})",
+                    docs)}
+
+        spans = word_spans(text)
+        # Spans index the lowercased text; it lines up with the original unless lowercasing changed its length
+        display = text if len(text.lower()) == len(text) else text.lower()
+        results = []
+        for doc, (pairs, matched) in ranked:
+            source, name, position, role = documents[doc]
+            passages = []
+            for qs, qe, ds, de in self._spans(pairs, self.K, self.K + self.WINDOW):
+                qe = min(qe, len(spans))
+                passages.append({
+                    "words": (qs, qe),
+                    "source_words": (ds, de),
+                    "excerpt": display[spans[qs][0]:spans[qe - 1][1]] if qs < qe else ""
+                })
+            results.append({
+                "source": source,
+                "name": name,
+                "position": position,
+                "role": role,
+                "matched_fingerprints": len(matched),
+                "coverage": round(len(matched) / len(query_offsets), 3),
+                "passages": passages
+            })
+        return results
+
+
+SEARCH_INDEXES = {
+    "bm25": BM25Index,
+    "trigram": TrigramIndex,
+    "columns": MetadataTable,
+    "fuzzy": FuzzyTitleIndex,
+    "prefix": PrefixIndex,
+    "fingerprint": FingerprintIndex,
+}
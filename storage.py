@@ -0,0 +1,1395 @@
+import atexit
+import bisect
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to exclusive lock-file creation
+    fcntl = None
+
+
+def conversation_metadata(chat_id, conv_data):
+    """Build the metadata row used by listings from a stored conversation"""
+    return {
+        'chat_id': chat_id,
+        'title': conv_data.get('title', 'Untitled'),
+        'timestamp': conv_data.get('timestamp', ''),
+        'message_count': conv_data.get('message_count', 0),
+        'date': conv_data.get('created_date', ''),
+        'time': conv_data.get('created_time', '')
+    }
+
+
+def timestamp_epoch(timestamp):
+    """Whole seconds since the epoch for an ISO timestamp (naive ones are local time); 0 if unparseable"""
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def date_range_epochs(start_date, end_date):
+    """[low, high) epoch bounds covering every local day from start_date to end_date inclusive"""
+    low = datetime.combine(start_date, datetime.min.time()).timestamp()
+    high = datetime.combine(end_date + timedelta(days=1), datetime.min.time()).timestamp()
+    return int(low), int(high)
+
+
+def file_signature(path):
+    """Cheap change detector for a file: (inode, size, mtime in ns)"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def atomic_write_json(path, data, **dump_kwargs):
+    """Write JSON to a temp file and rename it over path, so readers never see a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_bytes(path, data):
+    """Binary counterpart of atomic_write_json"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Highlight markers used in full-text snippets; control characters never typed in chats
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+def fts_phrase(text):
+    """Quote text as a single FTS5 phrase"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def fts_terms(query):
+    """Fallback FTS5 query: every whitespace-separated term quoted, keeping a trailing * as a prefix match"""
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*") and len(term) > 1
+        terms.append(fts_phrase(term.rstrip("*")) + ("*" if prefix else ""))
+    return " ".join(terms) or '""'
+
+
+def highlight_offsets(highlighted):
+    """(start, end) offsets of the marked spans in text produced by FTS5 highlight()"""
+    offsets = []
+    position = 0
+    start = None
+    for part in re.split(f"([{SNIPPET_START}{SNIPPET_END}])", highlighted):
+        if part == SNIPPET_START:
+            start = position
+        elif part == SNIPPET_END:
+            offsets.append((start, position))
+        else:
+            position += len(part)
+    return offsets
+
+
+class FileLock:
+    """Advisory inter-process lock held on a side file, waiting at most `timeout` seconds.
+
+    Re-entrant within a thread; different threads and processes exclude each other.
+    """
+
+    def __init__(self, path, timeout=10.0, poll_interval=0.005):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+    def acquire(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._local.depth = depth + 1
+            return
+        deadline = time.monotonic() + self.timeout
+        while True:
+            fd = self._try_acquire()
+            if fd is not None:
+                self._local.fd = fd
+                self._local.depth = 1
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out after {self.timeout}s waiting for lock {self.path}")
+            time.sleep(self.poll_interval)
+
+    def _try_acquire(self):
+        if fcntl is None:
+            try:
+                return os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+            except FileExistsError:
+                return None
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        fd = self._local.fd
+        self._local.fd = None
+        if fcntl is None:
+            os.close(fd)
+            os.remove(self.path)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def message_digests(messages, prefix_length):
+    """Running SHA-1 over messages: (digest of the first prefix_length, digest of all)"""
+    digest = hashlib.sha1()
+    prefix = digest.hexdigest() if prefix_length == 0 else None
+    for count, msg in enumerate(messages, 1):
+        digest.update(json.dumps(msg, sort_keys=True).encode('utf-8'))
+        digest.update(b"\n")
+        if count == prefix_length:
+            prefix = digest.hexdigest()
+    return prefix, digest.hexdigest()
+
+
+_STRUCTURAL = re.compile(rb'["\[\]{}]')
+_WHITESPACE = re.compile(rb'[ \t\r\n]*')
+_SCALAR = re.compile(rb'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+METADATA_FIELDS = ("title", "timestamp", "message_count", "created_date", "created_time")
+
+
+class _MetadataScanner:
+    """Incremental reader for {"conversations": {chat_id: {...}}} documents.
+
+    Only the requested scalar fields of each conversation are decoded; every
+    other value (notably the messages arrays) is skipped by jumping between
+    quotes and brackets with regex and memchr-style searches, so no Python
+    objects are built for message bodies.
+    """
+
+    def __init__(self, buf, fields):
+        self.buf = buf
+        self.fields = set(fields)
+
+    def _ws(self, pos):
+        return _WHITESPACE.match(self.buf, pos).end()
+
+    def _expect(self, pos, char):
+        pos = self._ws(pos)
+        if self.buf[pos:pos + 1] != char:
+            raise ValueError(f"Expected {char!r} at offset {pos}")
+        return pos + 1
+
+    def _string_end(self, pos):
+        """Offset just past the string whose opening quote is at pos"""
+        while True:
+            end = self.buf.find(b'"', pos + 1)
+            if end < 0:
+                raise ValueError("Unterminated string")
+            backslash = end - 1
+            while self.buf[backslash] == 0x5c:
+                backslash -= 1
+            if (end - 1 - backslash) % 2 == 0:
+                return end + 1
+            pos = end
+
+    def _skip_value(self, pos):
+        pos = self._ws(pos)
+        char = self.buf[pos:pos + 1]
+        if char == b'"':
+            return self._string_end(pos)
+        if char not in (b'[', b'{'):
+            match = _SCALAR.match(self.buf, pos)
+            if not match:
+                raise ValueError(f"Unexpected value at offset {pos}")
+            return match.end()
+        depth = 0
+        while True:
+            match = _STRUCTURAL.search(self.buf, pos)
+            if match is None:
+                raise ValueError("Unterminated container")
+            if match.group() == b'"':
+                pos = self._string_end(match.start())
+                continue
+            depth += 1 if match.group() in (b'[', b'{') else -1
+            pos = match.end()
+            if depth == 0:
+                return pos
+
+    def _value(self, pos):
+        """Decode a scalar value; containers are skipped and returned as None"""
+        start = self._ws(pos)
+        end = self._skip_value(start)
+        if self.buf[start:start + 1] in (b'[', b'{'):
+            return None, end
+        return json.loads(self.buf[start:end]), end
+
+    def _object(self, pos, handle):
+        """Walk an object, calling handle(key, value_offset) -> value end offset; returns end offset"""
+        pos = self._ws(self._expect(pos, b'{'))
+        if self.buf[pos:pos + 1] == b'}':
+            return pos + 1
+        while True:
+            pos = self._ws(pos)
+            if self.buf[pos:pos + 1] != b'"':
+                raise ValueError(f"Expected a key at offset {pos}")
+            key_end = self._string_end(pos)
+            key = json.loads(self.buf[pos:key_end])
+            pos = self._ws(handle(key, self._expect(key_end, b':')))
+            char = self.buf[pos:pos + 1]
+            if char == b'}':
+                return pos + 1
+            if char != b',':
+                raise ValueError(f"Expected ',' or '}}' at offset {pos}")
+            pos += 1
+
+    def scan(self):
+        """Yield (chat_id, {field: value}) for every conversation"""
+        results = []
+
+        def conversation(chat_id, pos):
+            row = {}
+
+            def field(key, value_pos):
+                if key in self.fields:
+                    row[key], end = self._value(value_pos)
+                    return end
+                return self._skip_value(value_pos)
+
+            end = self._object(pos, field)
+            results.append((chat_id, row))
+            return end
+
+        def top_level(key, pos):
+            if key == "conversations":
+                return self._object(pos, conversation)
+            return self._skip_value(pos)
+
+        self._object(0, top_level)
+        return results
+
+
+def scan_metadata(path, fields=METADATA_FIELDS):
+    """Read chat_id and selected scalar fields from a JSON history file without json.load.
+
+    The file is read through a memory map, so pages holding message bodies are
+    only touched by the C-level regex scans that skip over them.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"{path} is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _MetadataScanner(buf, fields).scan()
+
+
+class TimestampIndex:
+    """Rows kept sorted by (epoch, timestamp, id) for newest-first listings.
+
+    The epoch integer is computed once when a row is added, so keyset pages
+    and date ranges are binary searches over the sorted keys plus a slice.
+    """
+
+    def __init__(self, rows=(), key='timestamp', id_key='chat_id'):
+        self.key = key
+        self.id_key = id_key
+        self._rows = {row[id_key]: row for row in rows}
+        self._keys = sorted(self._sort_key(row) for row in self._rows.values())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _sort_key(self, row):
+        return (timestamp_epoch(row[self.key]), row[self.key], row[self.id_key])
+
+    def add(self, row):
+        """Insert or replace a row"""
+        self.remove(row[self.id_key])
+        self._rows[row[self.id_key]] = row
+        bisect.insort(self._keys, self._sort_key(row))
+
+    def remove(self, row_id):
+        """Drop a row if present"""
+        row = self._rows.pop(row_id, None)
+        if row is not None:
+            position = bisect.bisect_left(self._keys, self._sort_key(row))
+            del self._keys[position]
+
+    def _newest_first(self, start, end):
+        return [self._rows[key[-1]] for key in reversed(self._keys[start:end])]
+
+    def page(self, limit=None, before_timestamp=None, before_id=None):
+        """Up to `limit` rows (all if None) older than the (before_timestamp, before_id) cursor, newest first"""
+        if before_timestamp is None:
+            end = len(self._keys)
+        else:
+            # "" sorts before every id, so without before_id the whole timestamp is excluded
+            cursor = (timestamp_epoch(before_timestamp), before_timestamp, before_id or "")
+            end = bisect.bisect_left(self._keys, cursor)
+        start = 0 if limit is None else max(0, end - limit)
+        return self._newest_first(start, end)
+
+    def between(self, low, high):
+        """Rows whose epoch is in [low, high), newest first"""
+        return self._newest_first(bisect.bisect_left(self._keys, (low,)),
+                                  bisect.bisect_left(self._keys, (high,)))
+
+
+def write_batch(storage, items):
+    """Apply (chat_id, conversation-or-None) pairs, batched when the backend supports it"""
+    if hasattr(storage, "write_batch"):
+        storage.write_batch(items)
+        return
+    for chat_id, conversation in items:
+        if conversation is None:
+            storage.delete(chat_id)
+        else:
+            storage.put(chat_id, conversation)
+
+
+class JsonFileStorage:
+    """Single JSON document holding every conversation (the original layout).
+
+    The document is always replaced atomically. Updates are optimistic: the file
+    is parsed and modified without holding the lock, then committed under the
+    advisory lock only if its generation number is still the one that was read;
+    otherwise the update is retried, finally falling back to a fully locked
+    read-modify-write.
+
+    With streaming_metadata=True, listings use scan_metadata instead of
+    json.load, trading some speed for a peak memory that no longer grows with
+    the size of the message bodies.
+    """
+
+    MAX_OPTIMISTIC_RETRIES = 3
+    GENERATION_PATTERN = re.compile(rb'^\{\s*"generation":\s*(\d+)')
+
+    def __init__(self, path="chat_history.json", lock_timeout=10.0, streaming_metadata=False):
+        self.path = path
+        self.lock = FileLock(path + ".lock", timeout=lock_timeout)
+        self.streaming_metadata = streaming_metadata
+        self.ensure_file()
+
+    def ensure_file(self):
+        """Ensure the history file exists"""
+        if not os.path.exists(self.path):
+            with self.lock:
+                if not os.path.exists(self.path):
+                    atomic_write_json(self.path, {"generation": 0, "conversations": {}})
+
+    def signature(self):
+        """Value that changes whenever the history file is rewritten"""
+        return file_signature(self.path)
+
+    def _read(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _disk_generation(self):
+        """Generation of the file currently on disk, read from its first bytes only"""
+        with open(self.path, 'rb') as f:
+            match = self.GENERATION_PATTERN.search(f.read(64))
+        return int(match.group(1)) if match else 0
+
+    def _commit(self, data):
+        # Keep "generation" as the first key so _disk_generation finds it in the header
+        document = {"generation": data.get("generation", 0) + 1, "conversations": data["conversations"]}
+        atomic_write_json(self.path, document, indent=2)
+
+    def _update(self, mutate):
+        """Apply mutate(data) -> changed and commit the result without losing concurrent updates"""
+        for _ in range(self.MAX_OPTIMISTIC_RETRIES):
+            data = self._read()
+            if not mutate(data):
+                return False
+            with self.lock:
+                if self._disk_generation() == data.get("generation", 0):
+                    self._commit(data)
+                    return True
+        with self.lock:
+            data = self._read()
+            if not mutate(data):
+                return False
+            self._commit(data)
+            return True
+
+    def put(self, chat_id, conversation):
+        """Store or replace a conversation"""
+        def mutate(data):
+            data["conversations"][chat_id] = conversation
+            return True
+        self._update(mutate)
+
+    def get(self, chat_id):
+        """Return a stored conversation or None"""
+        return self._read()["conversations"].get(chat_id)
+
+    def delete(self, chat_id):
+        """Remove a conversation, returning whether it existed"""
+        def mutate(data):
+            return data["conversations"].pop(chat_id, None) is not None
+        return self._update(mutate)
+
+    def write_batch(self, items):
+        """Apply (chat_id, conversation-or-None) pairs with a single rewrite"""
+        def mutate(data):
+            for chat_id, conversation in items:
+                if conversation is None:
+                    data["conversations"].pop(chat_id, None)
+                else:
+                    data["conversations"][chat_id] = conversation
+            return True
+        self._update(mutate)
+
+    def metadata(self):
+        """Return metadata rows for every conversation (unsorted)"""
+        if self.streaming_metadata:
+            return [conversation_metadata(chat_id, fields) for chat_id, fields in scan_metadata(self.path)]
+        return [conversation_metadata(chat_id, conv_data)
+                for chat_id, conv_data in self._read()["conversations"].items()]
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs including messages"""
+        return iter(self._read()["conversations"].items())
+
+
+class JournalStorage:
+    """Append-only journal of put/delete records, replayed into memory on open.
+
+    A save appends one JSON line instead of rewriting the whole history; when
+    the stored messages are a prefix of the new ones only the new tail is
+    written. Records appended by other processes are picked up by replaying the
+    journal tail, and the journal is compacted once superseded records dominate
+    the file. The in-memory state is shared by every thread using the
+    instance, so replaying and reading it happen under a thread lock; writers
+    take the file lock first, then the thread lock. A record torn by a crashed
+    writer is cut off before the next append, and a line that still fails to
+    parse is salvaged (or skipped) on replay instead of breaking every open.
+    """
+
+    COMPACT_MIN_RECORDS = 1000
+    COMPACT_RATIO = 4
+
+    def __init__(self, path="chat_history.jsonl", legacy_path="chat_history.json", lock_timeout=10.0):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.lock = FileLock(path + ".lock", timeout=lock_timeout)
+        self._lock = threading.RLock()
+        self._state = {}
+        self._offset = 0
+        self._inode = None
+        self._records = 0
+        self.ensure_file()
+        self._replay()
+
+    def ensure_file(self):
+        """Create the journal, importing the legacy JSON history if present"""
+        if os.path.exists(self.path):
+            return
+        with self.lock:
+            if os.path.exists(self.path):
+                return
+            conversations = {}
+            if self.legacy_path and os.path.exists(self.legacy_path):
+                with open(self.legacy_path, 'r') as f:
+                    conversations = json.load(f).get("conversations", {})
+            self._rewrite(conversations)
+
+    def _rewrite(self, conversations):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            for chat_id, conv_data in conversations.items():
+                f.write(self._encode({"op": "put", "chat_id": chat_id, "data": conv_data}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def signature(self):
+        """Value that changes whenever a record is appended or the journal is compacted"""
+        return file_signature(self.path)
+
+    @staticmethod
+    def _encode(record):
+        return json.dumps(record, separators=(',', ':')) + "\n"
+
+    RECORD_START = b'{"op":'
+
+    @classmethod
+    def _decode(cls, line):
+        """The record on a journal line, or None if it is damaged beyond repair.
+
+        Journals written before torn tails were truncated can hold a partial
+        record with a complete one appended straight after it, so the complete
+        record is looked for after the damaged bytes.
+        """
+        start = 0
+        while start != -1:
+            try:
+                return json.loads(line[start:])
+            except ValueError:
+                start = line.find(cls.RECORD_START, start + 1)
+        return None
+
+    def _apply(self, record):
+        if record["op"] == "put":
+            self._state[record["chat_id"]] = record["data"]
+        elif record["op"] == "append":
+            stored = self._state.get(record["chat_id"]) or {}
+            conversation = dict(record["data"])
+            conversation["messages"] = stored.get("messages", [])[:record["start"]] + record["messages"]
+            self._state[record["chat_id"]] = conversation
+        elif record["op"] == "delete":
+            self._state.pop(record["chat_id"], None)
+        self._records += 1
+
+    def _replay(self):
+        """Apply records appended since the last replay (or everything after a compaction)"""
+        with self._lock:
+            self._replay_locked()
+
+    def _replay_locked(self):
+        stat = os.stat(self.path)
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._state = {}
+            self._offset = 0
+            self._records = 0
+            self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Partially written tail from a concurrent writer
+                    break
+                self._offset += len(line)
+                record = self._decode(line) if line.strip() else None
+                if record is not None:
+                    self._apply(record)
+
+    def _append(self, *records):
+        # Holding the lock keeps appends from landing in a journal that is being compacted away
+        with self.lock, self._lock:
+            self._replay()
+            with open(self.path, 'r+b') as f:
+                # Anything past the replayed offset is a record torn by a writer that died holding the lock
+                f.seek(self._offset)
+                f.truncate()
+                f.write("".join(self._encode(record) for record in records).encode('utf-8'))
+                self._offset = f.tell()
+            for record in records:
+                self._apply(record)
+            if (self._records >= self.COMPACT_MIN_RECORDS
+                    and self._records > self.COMPACT_RATIO * max(len(self._state), 1)):
+                self._compact_locked()
+
+    def compact(self):
+        """Rewrite the journal so it holds one put record per live conversation"""
+        with self.lock, self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        with self._lock:
+            self._replay()
+            self._rewrite(self._state)
+            self._inode = None
+            self._replay()
+
+    def _put_record(self, chat_id, conversation):
+        """An append record carrying only new messages when possible, else a full put"""
+        stored = (self._state.get(chat_id) or {}).get("messages")
+        messages = conversation.get("messages", [])
+        if stored and len(stored) <= len(messages) and messages[:len(stored)] == stored:
+            return {
+                "op": "append",
+                "chat_id": chat_id,
+                "start": len(stored),
+                "messages": messages[len(stored):],
+                "data": {k: v for k, v in conversation.items() if k != "messages"}
+            }
+        return {"op": "put", "chat_id": chat_id, "data": conversation}
+
+    def put(self, chat_id, conversation):
+        """Store or replace a conversation"""
+        self.write_batch([(chat_id, conversation)])
+
+    def get(self, chat_id):
+        """Return a stored conversation or None"""
+        with self._lock:
+            self._replay()
+            return self._state.get(chat_id)
+
+    def write_batch(self, items):
+        """Apply (chat_id, conversation-or-None) pairs with a single append"""
+        with self.lock, self._lock:
+            # Deltas are computed against the latest state, including other processes' records
+            self._replay()
+            latest = dict(items)
+            self._append(*[self._put_record(chat_id, conversation) if conversation is not None
+                           else {"op": "delete", "chat_id": chat_id}
+                           for chat_id, conversation in latest.items()])
+
+    def delete(self, chat_id):
+        """Remove a conversation, returning whether it existed"""
+        with self.lock, self._lock:
+            self._replay()
+            if chat_id not in self._state:
+                return False
+            self._append({"op": "delete", "chat_id": chat_id})
+            return True
+
+    def metadata(self):
+        """Return metadata rows for every conversation (unsorted)"""
+        with self._lock:
+            self._replay()
+            return [conversation_metadata(chat_id, conv_data)
+                    for chat_id, conv_data in self._state.items()]
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs including messages"""
+        with self._lock:
+            self._replay()
+            return iter(list(self._state.items()))
+
+
+class SQLiteStorage:
+    """SQLite database with a conversations table and a messages table.
+
+    Listing and date/size filters only touch the indexed conversations table,
+    so they never parse message bodies. Each conversation row keeps a digest of
+    its stored messages, so a save whose messages extend the stored ones
+    inserts only the new rows.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            chat_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            created_date TEXT NOT NULL,
+            created_time TEXT NOT NULL,
+            digest TEXT
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id TEXT NOT NULL REFERENCES conversations(chat_id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            extra TEXT,
+            PRIMARY KEY (chat_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_conversations_timestamp_chat ON conversations(timestamp, chat_id);
+        CREATE INDEX IF NOT EXISTS idx_conversations_message_count ON conversations(message_count);
+        CREATE INDEX IF NOT EXISTS idx_conversations_created_date ON conversations(created_date);
+    """
+
+    # External-content FTS5 index over messages.content, kept in step by triggers
+    # (foreign-key cascades fire the delete trigger too)
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='rowid'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.rowid, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.rowid, new.content);
+        END;
+    """
+
+    METADATA_COLUMNS = "chat_id, title, timestamp, message_count, created_date, created_time"
+
+    def __init__(self, path="chat_history.db", legacy_path="chat_history.json", lock_timeout=10.0):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._lock = threading.Lock()
+        # Streamlit reruns execute on different threads; access is serialized by _lock.
+        # Other processes are handled by SQLite's own locking, waiting up to lock_timeout.
+        # Writes also hold the advisory lock so a cache can read the signature its own write produced.
+        self.lock = FileLock(path + ".lock", timeout=lock_timeout)
+        self._conn = sqlite3.connect(path, timeout=lock_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        # Python's str.lower keeps search semantics identical to the JSON backend
+        self._conn.create_function("py_lower", 1, lambda text: (text or "").lower(), deterministic=True)
+        # Separate connection for signature(), so checking for changes never waits behind a
+        # long write on _conn; its data_version moves with every commit, ours included
+        self._watch_lock = threading.Lock()
+        self._watch = sqlite3.connect(path, timeout=lock_timeout, check_same_thread=False)
+        self.full_text = False
+        self.ensure_file()
+
+    # PRAGMA user_version once the legacy JSON history has been imported (or found unnecessary)
+    LEGACY_IMPORTED = 1
+
+    def ensure_file(self):
+        """Create the schema, importing the legacy JSON history into a new database exactly once"""
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+            if "digest" not in columns:
+                self._conn.execute("ALTER TABLE conversations ADD COLUMN digest TEXT")
+            self.full_text = self._ensure_full_text()
+            imported = self._conn.execute("PRAGMA user_version").fetchone()[0] >= self.LEGACY_IMPORTED
+            # Databases created before the marker existed count as imported once they hold anything
+            empty = self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == 0
+        if not imported:
+            conversations = {}
+            if empty and self.legacy_path and os.path.exists(self.legacy_path):
+                with open(self.legacy_path, 'r') as f:
+                    conversations = json.load(f).get("conversations", {})
+            # The import and its marker commit together
+            with self._lock, self._conn:
+                for chat_id, conv_data in conversations.items():
+                    self._put_locked(chat_id, conv_data)
+                self._conn.execute(f"PRAGMA user_version = {self.LEGACY_IMPORTED}")
+
+    def _ensure_full_text(self):
+        existed = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        try:
+            self._conn.executescript(self.FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: full_text_search is unavailable
+            return False
+        if not existed:
+            # Index messages stored before the FTS table was added
+            self._conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        return True
+
+    def signature(self):
+        """Value that changes whenever this or another connection commits"""
+        with self._watch_lock:
+            return self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    @staticmethod
+    def _metadata_row(row):
+        return conversation_metadata(row[0], {
+            'title': row[1],
+            'timestamp': row[2],
+            'message_count': row[3],
+            'created_date': row[4],
+            'created_time': row[5]
+        })
+
+    def _select_metadata(self, where="", params=(), limit=None):
+        sql = f"SELECT {self.METADATA_COLUMNS} FROM conversations {where} ORDER BY timestamp DESC, chat_id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = tuple(params) + (limit,)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._metadata_row(row) for row in rows]
+
+    def put(self, chat_id, conversation):
+        """Store or replace a conversation"""
+        self.write_batch([(chat_id, conversation)])
+
+    def write_batch(self, items):
+        """Apply (chat_id, conversation-or-None) pairs in one transaction"""
+        with self.lock, self._lock, self._conn:
+            for chat_id, conversation in items:
+                if conversation is None:
+                    self._conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+                else:
+                    self._put_locked(chat_id, conversation)
+
+    def _put_locked(self, chat_id, conversation):
+        messages = conversation.get("messages", [])
+        stored = self._conn.execute(
+            "SELECT message_count, digest FROM conversations WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        stored_count, stored_digest = stored if stored else (0, None)
+        prefix_digest, digest = message_digests(messages, stored_count)
+
+        # Only insert the new tail when the stored rows are an unchanged prefix
+        start = stored_count if stored_digest is not None and prefix_digest == stored_digest else 0
+        message_rows = []
+        for position, msg in enumerate(messages[start:], start):
+            extra = {k: v for k, v in msg.items() if k not in ("role", "content")}
+            message_rows.append((chat_id, position, msg.get("role", ""), msg.get("content", ""),
+                                 json.dumps(extra) if extra else None))
+        self._conn.execute(
+            "INSERT INTO conversations (chat_id, title, timestamp, message_count, created_date, created_time, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(chat_id) DO UPDATE SET "
+            "title = excluded.title, timestamp = excluded.timestamp, message_count = excluded.message_count, "
+            "created_date = excluded.created_date, created_time = excluded.created_time, digest = excluded.digest",
+            (chat_id, conversation.get("title", "Untitled"), conversation.get("timestamp", ""),
+             len(messages), conversation.get("created_date", ""), conversation.get("created_time", ""), digest)
+        )
+        self._conn.execute("DELETE FROM messages WHERE chat_id = ? AND position >= ?", (chat_id, start))
+        self._conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", message_rows)
+
+    def get(self, chat_id):
+        """Return a stored conversation or None"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {self.METADATA_COLUMNS} FROM conversations WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            message_rows = self._conn.execute(
+                "SELECT role, content, extra FROM messages WHERE chat_id = ? ORDER BY position", (chat_id,)
+            ).fetchall()
+        messages = []
+        for role, content, extra in message_rows:
+            msg = {"role": role, "content": content}
+            if extra:
+                msg.update(json.loads(extra))
+            messages.append(msg)
+        return {
+            "chat_id": row[0],
+            "title": row[1],
+            "messages": messages,
+            "timestamp": row[2],
+            "message_count": row[3],
+            "created_date": row[4],
+            "created_time": row[5]
+        }
+
+    def delete(self, chat_id):
+        """Remove a conversation, returning whether it existed"""
+        with self.lock, self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+        return cursor.rowcount > 0
+
+    def metadata(self):
+        """Return metadata rows for every conversation, newest first"""
+        return self._select_metadata()
+
+    def metadata_page(self, limit, before_timestamp=None, before_chat_id=None):
+        """Up to `limit` metadata rows (all if None) older than the cursor, newest first (index range scan)"""
+        if before_timestamp is None:
+            return self._select_metadata(limit=limit)
+        return self._select_metadata("WHERE (timestamp, chat_id) < (?, ?)",
+                                     (before_timestamp, before_chat_id or ""), limit=limit)
+
+    def count(self):
+        """Number of stored conversations"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def metadata_between(self, start_date, end_date):
+        """Return metadata rows whose timestamp falls on a day in [start_date, end_date]"""
+        end_exclusive = end_date + timedelta(days=1)
+        return self._select_metadata("WHERE timestamp >= ? AND timestamp < ?",
+                                     (start_date.isoformat(), end_exclusive.isoformat()))
+
+    def metadata_by_message_count(self, min_messages, max_messages):
+        """Return metadata rows with min_messages <= message_count <= max_messages"""
+        return self._select_metadata("WHERE message_count BETWEEN ? AND ?", (min_messages, max_messages))
+
+    def search(self, query):
+        """Return metadata rows whose title or any message contains query (case-insensitive)"""
+        query_lower = query.lower()
+        return self._select_metadata(
+            "WHERE instr(py_lower(title), ?) > 0 OR EXISTS ("
+            "SELECT 1 FROM messages WHERE messages.chat_id = conversations.chat_id "
+            "AND instr(py_lower(content), ?) > 0)",
+            (query_lower, query_lower)
+        )
+
+    def full_text_search(self, query, n_results=10, snippet_tokens=12):
+        """Rank conversations by FTS5 bm25 over message content.
+
+        query uses FTS5 syntax ("exact phrase", prefix*, AND/OR/NOT); input that
+        does not parse is retried as a conjunction of quoted terms. Each returned
+        metadata row carries the best message's 'snippet' (matches wrapped in
+        SNIPPET_START/SNIPPET_END) and 'matches': the matching messages'
+        positions, roles and (start, end) character offsets of every hit.
+        """
+        # The rank column is bm25 (auxiliary functions such as bm25() cannot be aggregated)
+        ranked = ("SELECT messages.chat_id FROM messages_fts JOIN messages ON messages.rowid = messages_fts.rowid "
+                  "WHERE messages_fts MATCH ? GROUP BY messages.chat_id "
+                  "ORDER BY min(messages_fts.rank) LIMIT ?")
+        markers = (SNIPPET_START, SNIPPET_END)
+        with self._lock:
+            # Rank chats first so snippet() and highlight() only run on the returned chats' messages
+            for match in (query, fts_terms(query)):
+                try:
+                    chat_ids = [row[0] for row in self._conn.execute(ranked, (match, n_results))]
+                    break
+                except sqlite3.OperationalError:
+                    chat_ids = []
+            rows = []
+            if chat_ids:
+                placeholders = ", ".join("?" * len(chat_ids))
+                rows = self._conn.execute(
+                    "SELECT messages.chat_id, messages.position, messages.role, "
+                    "snippet(messages_fts, 0, ?, ?, '…', ?), highlight(messages_fts, 0, ?, ?) "
+                    "FROM messages_fts JOIN messages ON messages.rowid = messages_fts.rowid "
+                    f"WHERE messages_fts MATCH ? AND messages.chat_id IN ({placeholders}) "
+                    "ORDER BY bm25(messages_fts)",
+                    markers + (snippet_tokens,) + markers + (match,) + tuple(chat_ids)
+                ).fetchall()
+        hits = {chat_id: {"snippet": None, "matches": []} for chat_id in chat_ids}
+        for chat_id, position, role, snippet, highlighted in rows:
+            hit = hits[chat_id]
+            if hit["snippet"] is None:
+                hit["snippet"] = snippet
+            hit["matches"].append({"position": position, "role": role,
+                                   "offsets": highlight_offsets(highlighted)})
+        if not hits:
+            return []
+        placeholders = ", ".join("?" * len(hits))
+        rows = {row['chat_id']: row for row in
+                self._select_metadata(f"WHERE chat_id IN ({placeholders})", tuple(hits))}
+        return [dict(rows[chat_id], **hit) for chat_id, hit in hits.items() if chat_id in rows]
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs including messages"""
+        with self._lock:
+            chat_ids = [row[0] for row in self._conn.execute("SELECT chat_id FROM conversations")]
+        for chat_id in chat_ids:
+            conv_data = self.get(chat_id)
+            if conv_data is not None:
+                yield chat_id, conv_data
+
+
+class ShardedStorage:
+    """One JSON file per conversation plus a small manifest of listing fields.
+
+    Loading a conversation opens a single shard and listings read only the
+    manifest, so neither cost grows with the size of other conversations.
+    """
+
+    MANIFEST_FIELDS = ("title", "timestamp", "message_count", "created_date", "created_time")
+    SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,100}$")
+
+    def __init__(self, path="chat_history_shards", legacy_path="chat_history.json",
+                 manifest_fields=MANIFEST_FIELDS, lock_timeout=10.0):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.manifest_fields = tuple(manifest_fields)
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.shard_dir = os.path.join(path, "conversations")
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.lock = FileLock(os.path.join(path, "manifest.lock"), timeout=lock_timeout)
+        self.ensure_file()
+
+    def ensure_file(self):
+        """Create the shard directory and manifest, importing the legacy JSON history"""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            return
+        conversations = {}
+        if self.legacy_path and os.path.exists(self.legacy_path):
+            with open(self.legacy_path, 'r') as f:
+                conversations = json.load(f).get("conversations", {})
+        with self.lock:
+            if os.path.exists(self.manifest_path):
+                return
+            for chat_id, conv_data in conversations.items():
+                self._write_json(self._shard_path(chat_id), conv_data)
+            self._write_json(self.manifest_path, {chat_id: self._manifest_entry(conv_data)
+                                                  for chat_id, conv_data in conversations.items()})
+
+    @staticmethod
+    def _write_json(path, data):
+        atomic_write_json(path, data, separators=(',', ':'))
+
+    def _manifest_entry(self, conversation):
+        return {field: conversation.get(field) for field in self.manifest_fields if field in conversation}
+
+    def _shard_path(self, chat_id):
+        name = chat_id if self.SAFE_ID.match(chat_id) else hashlib.sha1(chat_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.shard_dir, name + ".json")
+
+    def signature(self):
+        """Value that changes whenever the manifest is rewritten (every put and delete)"""
+        return file_signature(self.manifest_path)
+
+    def read_manifest(self):
+        """Return the manifest mapping chat_id -> listing fields"""
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def put(self, chat_id, conversation):
+        """Store or replace a conversation"""
+        with self.lock:
+            self._write_json(self._shard_path(chat_id), conversation)
+            manifest = self.read_manifest()
+            manifest[chat_id] = self._manifest_entry(conversation)
+            self._write_json(self.manifest_path, manifest)
+
+    def get(self, chat_id):
+        """Return a stored conversation or None"""
+        try:
+            with open(self._shard_path(chat_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, chat_id):
+        """Remove a conversation, returning whether it existed"""
+        with self.lock:
+            manifest = self.read_manifest()
+            existed = manifest.pop(chat_id, None) is not None
+            if existed:
+                self._write_json(self.manifest_path, manifest)
+            try:
+                os.remove(self._shard_path(chat_id))
+            except FileNotFoundError:
+                pass
+            return existed
+
+    def metadata(self):
+        """Return metadata rows for every conversation (unsorted), read from the manifest only"""
+        return [conversation_metadata(chat_id, entry) for chat_id, entry in self.read_manifest().items()]
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs including messages"""
+        for chat_id in list(self.read_manifest()):
+            conv_data = self.get(chat_id)
+            if conv_data is not None:
+                yield chat_id, conv_data
+
+
+class CachedStorage:
+    """Process-wide in-memory model of a storage backend.
+
+    Every read first compares the backend's signature (file stat or SQLite
+    data_version) with the one seen at load time; only a change made by
+    another process drops the cache. Writes go through to the backend and
+    update the cache in place; they hold the backend's lock (if it has one)
+    from the signature check before the write to the signature read after
+    it, so another process's write can never be mistaken for our own. Over a
+    WriteBehindStorage a write only queues and leaves the signature alone, so
+    it takes neither the lock nor a second signature read and never waits for
+    a flush. Optional backend capabilities such as ``search`` are forwarded
+    unchanged.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.path = backend.path
+        self._lock = threading.RLock()
+        self._signature = None
+        self._metadata = None
+        self._index = None
+        self._conversations = {}
+        self._complete = False
+        self._queued = isinstance(backend, WriteBehindStorage)
+
+    def __getattr__(self, name):
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def _validate(self):
+        signature = self.backend.signature()
+        if signature != self._signature:
+            self._metadata = None
+            self._index = None
+            self._conversations = {}
+            self._complete = False
+            self._signature = signature
+
+    def _remember(self, chat_id, conversation):
+        self._conversations[chat_id] = conversation
+        if conversation is None:
+            if self._metadata is not None:
+                self._metadata.pop(chat_id, None)
+            if self._index is not None:
+                self._index.remove(chat_id)
+            return
+        row = conversation_metadata(chat_id, conversation)
+        if self._metadata is not None:
+            self._metadata[chat_id] = row
+        if self._index is not None:
+            self._index.add(row)
+
+    def _load_metadata(self):
+        if self._metadata is None:
+            self._metadata = {row['chat_id']: row for row in self.backend.metadata()}
+        return self._metadata
+
+    def ensure_file(self):
+        """Ensure the underlying store exists"""
+        with self._lock:
+            self.backend.ensure_file()
+            self._validate()
+
+    def _write(self, apply, items):
+        # Only a write-through backend's lock has to cover the two signature reads
+        lock = None if self._queued else getattr(self.backend, "lock", None)
+        with self._lock, lock or contextlib.nullcontext():
+            # Drops the cache if someone else wrote since our last look
+            self._validate()
+            result = apply()
+            for chat_id, conversation in items:
+                self._remember(chat_id, conversation)
+            if not self._queued:
+                self._signature = self.backend.signature()
+            return result
+
+    def put(self, chat_id, conversation):
+        """Store or replace a conversation"""
+        self._write(lambda: self.backend.put(chat_id, conversation), [(chat_id, conversation)])
+
+    def get(self, chat_id):
+        """Return a stored conversation or None"""
+        with self._lock:
+            self._validate()
+            if chat_id not in self._conversations and not self._complete:
+                self._conversations[chat_id] = self.backend.get(chat_id)
+            return self._conversations.get(chat_id)
+
+    def delete(self, chat_id):
+        """Remove a conversation, returning whether it existed"""
+        return self._write(lambda: self.backend.delete(chat_id), [(chat_id, None)])
+
+    def write_batch(self, items):
+        """Apply (chat_id, conversation-or-None) pairs and update the cache in place"""
+        items = list(items)
+        self._write(lambda: write_batch(self.backend, items), items)
+
+    def metadata(self):
+        """Return metadata rows for every conversation (unsorted)"""
+        with self._lock:
+            self._validate()
+            return list(self._load_metadata().values())
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = TimestampIndex(self._load_metadata().values())
+        return self._index
+
+    def metadata_page(self, limit, before_timestamp=None, before_chat_id=None):
+        """Up to `limit` metadata rows (all if None) older than the cursor, newest first"""
+        with self._lock:
+            self._validate()
+            return self._load_index().page(limit, before_timestamp, before_chat_id)
+
+    def metadata_between(self, start_date, end_date):
+        """Return metadata rows whose timestamp falls on a day in [start_date, end_date], newest first"""
+        with self._lock:
+            self._validate()
+            return self._load_index().between(*date_range_epochs(start_date, end_date))
+
+    def count(self):
+        """Number of stored conversations"""
+        with self._lock:
+            self._validate()
+            return len(self._load_metadata())
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs including messages"""
+        with self._lock:
+            self._validate()
+            if not self._complete:
+                self._conversations = dict(self.backend.conversations())
+                self._complete = True
+            return iter([(chat_id, conv_data) for chat_id, conv_data in self._conversations.items()
+                         if conv_data is not None])
+
+
+class WriteBehindStorage:
+    """Queue writes in memory and flush them to the wrapped storage from a background thread.
+
+    Pending saves for the same chat_id collapse into one, so a burst of saves
+    costs a single write. Reads overlay the pending queue, so callers always see
+    their own writes. A final flush runs at interpreter shutdown. A failed flush
+    keeps its items queued and the error is re-raised by the next write call.
+
+    signature() hides the changes made by our own flushes (readers have already
+    seen those items through the queue), so a CachedStorage layered on top
+    stays warm; writes from other processes still change it. Other backend
+    queries flush first, since they cannot see the queue.
+    """
+
+    def __init__(self, storage, flush_interval=0.5, max_batch=256):
+        self.storage = storage
+        self.path = storage.path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._aliases = {}  # backend signature after our last flush -> signature reported before it
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="history-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        if name == "storage":
+            raise AttributeError(name)
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        def flushed(*args, **kwargs):
+            # Backend-specific queries cannot see the queue, so drain it first
+            self.flush()
+            return attr(*args, **kwargs)
+        return flushed
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _enqueue(self, chat_id, conversation):
+        with self._lock:
+            error, self.last_error = self.last_error, None
+            self._pending.pop(chat_id, None)
+            self._pending[chat_id] = conversation
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.set()
+        if error is not None:
+            raise error
+
+    def flush(self):
+        """Write every pending item to the wrapped storage"""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    chat_ids = list(self._pending)[:self.max_batch]
+                    items = [(chat_id, self._pending[chat_id]) for chat_id in chat_ids]
+                try:
+                    # Under the backend lock nobody else can write between the two signature reads
+                    with getattr(self.storage, "lock", None) or contextlib.nullcontext():
+                        before = self.storage.signature()
+                        write_batch(self.storage, items)
+                        after = self.storage.signature()
+                except Exception as e:
+                    with self._lock:
+                        self.last_error = e
+                    return
+                with self._lock:
+                    self._aliases = {after: self._aliases.get(before, before)}
+                    for chat_id, conversation in items:
+                        # Leave entries that were re-queued while this batch was being written
+                        if self._pending.get(chat_id, object()) is conversation:
+                            del self._pending[chat_id]
+
+    def close(self):
+        """Stop the flusher thread and write everything still pending"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def ensure_file(self):
+        """Ensure the underlying store exists"""
+        self.storage.ensure_file()
+
+    def signature(self):
+        """The backend's signature, unchanged by our own flushes"""
+        signature = self.storage.signature()
+        with self._lock:
+            return self._aliases.get(signature, signature)
+
+    def put(self, chat_id, conversation):
+        """Queue a conversation to be stored"""
+        self._enqueue(chat_id, conversation)
+
+    def get(self, chat_id):
+        """Return a conversation, preferring a pending write"""
+        with self._lock:
+            if chat_id in self._pending:
+                return self._pending[chat_id]
+        return self.storage.get(chat_id)
+
+    def delete(self, chat_id):
+        """Queue a conversation for removal, returning whether it existed"""
+        existed = self.get(chat_id) is not None
+        self._enqueue(chat_id, None)
+        return existed
+
+    def write_batch(self, items):
+        """Queue (chat_id, conversation-or-None) pairs"""
+        for chat_id, conversation in items:
+            self._enqueue(chat_id, conversation)
+
+    def _overlay(self, rows, make_row):
+        with self._lock:
+            pending = dict(self._pending)
+        merged = {chat_id: row for chat_id, row in rows if chat_id not in pending}
+        for chat_id, conversation in pending.items():
+            if conversation is not None:
+                merged[chat_id] = make_row(chat_id, conversation)
+        return merged
+
+    def metadata(self):
+        """Return metadata rows for every conversation (unsorted), including pending writes"""
+        rows = ((row['chat_id'], row) for row in self.storage.metadata())
+        return list(self._overlay(rows, conversation_metadata).values())
+
+    def conversations(self):
+        """Iterate over (chat_id, conversation) pairs, including pending writes"""
+        return iter(self._overlay(self.storage.conversations(), lambda chat_id, conv: conv).items())
+
+
+STORAGE_BACKENDS = {
+    "json": JsonFileStorage,
+    "journal": JournalStorage,
+    "sqlite": SQLiteStorage,
+    "sharded": ShardedStorage,
+}
+
+
+def create_storage(backend="json", cache=False, write_behind=False, **kwargs):
+    """Instantiate a storage backend by name, optionally behind a cache and a write-behind queue"""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    storage = STORAGE_BACKENDS[backend](**kwargs)
+    # The queue sits under the cache: the cache answers listings and counts from
+    # memory, so reads never wait for a flush
+    if write_behind:
+        storage = WriteBehindStorage(storage)
+    if cache:
+        storage = CachedStorage(storage)
+    return storage
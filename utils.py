@@ -3,6 +3,9 @@ import json
 from datetime import datetime, timedelta
 import re
 
+from originality import originality_report
+from storage import SNIPPET_START, SNIPPET_END
+
 class AIResponseHandler:
     """Enhanced AI response handling with multiple capabilities"""
     
@@ -126,6 +129,12 @@ class ChatUtils:
         
         return text
     
+    @staticmethod
+    def format_snippet(snippet):
+        """Render a full-text snippet as escaped HTML with matches in <mark> tags"""
+        text = ChatUtils.clean_text(snippet)
+        return text.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+    
     @staticmethod
     def estimate_reading_time(text):
         """Estimate reading time for text"""
@@ -192,49 +201,31 @@ class AdvancedSearch:
     @staticmethod
     def search_by_date_range(chat_manager, start_date, end_date):
         """Search conversations by date range"""
-        all_conversations = chat_manager.get_all_conversations()
-        filtered = []
-        
-        for conv in all_conversations:
-            try:
-                conv_date = datetime.fromisoformat(conv['timestamp']).date()
-                if start_date <= conv_date <= end_date:
-                    filtered.append(conv)
-            except:
-                continue
-        
-        return filtered
+        return chat_manager.get_conversations_between(start_date, end_date)
     
     @staticmethod
     def search_by_message_count(chat_manager, min_messages=0, max_messages=1000):
         """Search conversations by message count"""
-        all_conversations = chat_manager.get_all_conversations()
-        return [conv for conv in all_conversations 
-                if min_messages <= conv.get('message_count', 0) <= max_messages]
+        return chat_manager.get_conversations_by_message_count(min_messages, max_messages)
     
     @staticmethod
-    def search_by_keywords(chat_manager, keywords):
-        """Search conversations by specific keywords"""
-        results = []
-        for keyword in keywords:
-            keyword_results = chat_manager.search_conversations(keyword, n_results=50)
-            results.extend(keyword_results)
-        
-        # Remove duplicates while preserving order
-        seen = set()
-        unique_results = []
-        for item in results:
-            if item['chat_id'] not in seen:
-                seen.add(item['chat_id'])
-                unique_results.append(item)
-        
-        return unique_results
+    def search_by_keywords(chat_manager, keywords, match="any", n_results=50):
+        """Search conversations by specific keywords (match="any" or "all"), best-scoring first"""
+        return chat_manager.search_keywords(keywords, match, n_results)
+    
+    @staticmethod
+    def search_hybrid(chat_manager, query, n_results=20):
+        """Search conversations by words and meaning together, each row carrying per-signal ranks and scores"""
+        return chat_manager.hybrid_search(query, n_results)
 
-def get_response_stats(text):
-    """Get statistics about the response"""
-    return {
+def get_response_stats(text, source=None):
+    """Get statistics about the response, plus how original it is relative to source when given"""
+    stats = {
         'word_count': len(text.split()),
         'character_count': len(text),
         'reading_time': ChatUtils.estimate_reading_time(text),
         'keywords': ChatUtils.extract_keywords(text)
     }
+    if source is not None:
+        stats['originality'] = originality_report(source, text)
+    return stats
@@ -0,0 +1,555 @@
+import atexit
+import hashlib
+import os
+import pickle
+import threading
+
+import numpy as np
+
+from embeddings import default_embedder
+from search_index import ConversationIndex, conversation_text
+from storage import atomic_write_bytes
+
+
+class SemanticIndex(ConversationIndex):
+    """Approximate nearest-neighbour search over conversation embeddings.
+
+    Each conversation is embedded once, when it is indexed. Vectors live in
+    one float32 array (deletes move the last row into the hole) and are
+    bucketed by random-hyperplane LSH: N_TABLES tables of N_BITS-bit sign
+    codes. A query probes its own bucket and every bucket one bit away in
+    each table, then ranks the candidates by exact cosine similarity. Up to
+    EXACT_LIMIT conversations a full scan is cheaper and is used instead.
+    With a path, the default embedder caches vectors in embedding_cache.db
+    beside the index, so rebuilding it re-embeds only changed text.
+    """
+
+    N_TABLES = 12
+    N_BITS = 10
+    EXACT_LIMIT = 20000
+
+    def __init__(self, path=None, embedder=None):
+        if embedder is None:
+            embedder = default_embedder(os.path.join(os.path.dirname(path) or ".", "embedding_cache.db")
+                                        if path else None)
+        self.embedder = embedder
+        rng = np.random.default_rng(20240601)
+        self.planes = rng.standard_normal((self.embedder.dim, self.N_TABLES * self.N_BITS), dtype=np.float32)
+        self.powers = 1 << np.arange(self.N_BITS, dtype=np.int64)
+        super().__init__(path)
+
+    def _restore(self, state):
+        if state and state["model"] != self.embedder.version:
+            raise ValueError("index was built with a different embedding model")
+        self.chat_ids = state["chat_ids"] if state else []
+        self.vectors = state["vectors"] if state else np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.positions = {chat_id: i for i, chat_id in enumerate(self.chat_ids)}
+        self.buckets = [{} for _ in range(self.N_TABLES)]
+        for chat_id, codes in zip(self.chat_ids, self._codes(self.vectors[:len(self.chat_ids)]).tolist()):
+            self._bucket(chat_id, codes)
+
+    def _state(self):
+        return {"model": self.embedder.version, "chat_ids": self.chat_ids,
+                "vectors": self.vectors[:len(self.chat_ids)]}
+
+    def _codes(self, vectors):
+        """(n, N_TABLES) LSH bucket codes"""
+        bits = (vectors @ self.planes > 0).reshape(len(vectors), self.N_TABLES, self.N_BITS)
+        return bits @ self.powers
+
+    def _bucket(self, chat_id, codes):
+        for table, code in zip(self.buckets, codes):
+            table.setdefault(code, set()).add(chat_id)
+
+    def _index_document(self, chat_id, conversation):
+        vector = self.embedder.embed([conversation_text(conversation)])[0]
+        position = len(self.chat_ids)
+        if position == len(self.vectors):
+            grown = np.zeros((max(1024, 2 * position), self.embedder.dim), dtype=np.float32)
+            grown[:position] = self.vectors[:position]
+            self.vectors = grown
+        self.vectors[position] = vector
+        self.chat_ids.append(chat_id)
+        self.positions[chat_id] = position
+        self._bucket(chat_id, self._codes(vector[None])[0].tolist())
+
+    def _unindex_document(self, chat_id):
+        position = self.positions.pop(chat_id)
+        for table, code in zip(self.buckets, self._codes(self.vectors[position][None])[0].tolist()):
+            bucket = table[code]
+            bucket.discard(chat_id)
+            if not bucket:
+                del table[code]
+        last = len(self.chat_ids) - 1
+        if position != last:
+            self.vectors[position] = self.vectors[last]
+            self.chat_ids[position] = self.chat_ids[last]
+            self.positions[self.chat_ids[position]] = position
+        self.chat_ids.pop()
+
+    def _candidates(self, vector):
+        candidates = set()
+        for table, code in zip(self.buckets, self._codes(vector[None])[0].tolist()):
+            candidates.update(table.get(code, ()))
+            for bit in range(self.N_BITS):
+                candidates.update(table.get(code ^ (1 << bit), ()))
+        return np.fromiter((self.positions[chat_id] for chat_id in candidates), dtype=np.int64,
+                           count=len(candidates))
+
+    def search(self, query, n_results=10):
+        """Metadata rows of the conversations most similar to query, each with its cosine score"""
+        vector = self.embedder.embed([query])[0]
+        if not vector.any():
+            return []
+        with self._lock:
+            if len(self.chat_ids) <= self.EXACT_LIMIT:
+                positions = np.arange(len(self.chat_ids))
+                scores = self.vectors[:len(self.chat_ids)] @ vector
+            else:
+                positions = self._candidates(vector)
+                scores = self.vectors[positions] @ vector
+            if len(scores) > n_results:
+                best = np.argpartition(-scores, n_results)[:n_results]
+            else:
+                best = np.arange(len(scores))
+            best = best[np.argsort(-scores[best])]
+            return [dict(self.rows[self.chat_ids[positions[i]]], score=round(float(scores[i]), 3))
+                    for i in best.tolist() if scores[i] > 0]
+
+
+def quantize(vectors):
+    """Symmetric per-row int8 quantization: (int8 codes, float32 scales) with vectors ~= codes * scales"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    codes = np.zeros(vectors.shape, dtype=np.int8)
+    nonzero = scales > 0
+    codes[nonzero] = np.rint(vectors[nonzero] / scales[nonzero, None])
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedVectorIndex:
+    """Exact top-k over int8-quantized vectors kept in memory-mapped files; a ChromaDB-free collection.
+
+    Vectors are stored as int8 codes plus one float32 scale per row in
+    <path>/vectors.i8 and <path>/scales.f4, which grow by doubling. A query is
+    scored block by block (BLOCK_ROWS rows at a time), so memory use stays
+    flat however large the index is; within a block, 1024-row tiles are widened
+    to float32 in a reused buffer before the BLAS matrix-vector product.
+    Deletes move the last row into the hole.
+
+    Ids and metadata are kept as a snapshot (<path>/rows.pkl) plus a log of
+    row changes (<path>/rows.log): save(), which ChromaChunkStore calls after
+    every flush and which also runs at exit, appends only the changes since
+    the previous save, and rewrites the snapshot once the log holds more
+    changes than half the index's rows. Vectors change in place, so
+    <path>/header.i8 holds a generation number and a dirty flag that is set
+    before the first change after a save. Rows that do not replay to the
+    header's generation, or a dirty flag left by a crash, mean ids may point
+    at the wrong vectors: the index then starts empty and is rebuilt by
+    re-ingesting. get/upsert/delete/query follow the subset of
+    the ChromaDB collection API that ChromaChunkStore uses; documents are not
+    stored.
+    """
+
+    BLOCK_ROWS = 65536
+    TILE_ROWS = 1024
+    COMPACT_MIN_CHANGES = 65536
+
+    def __init__(self, path="vector_index", dim=256):
+        self.path = path
+        self.dim = dim
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.rows_path = os.path.join(path, "rows.pkl")
+        self.log_path = os.path.join(path, "rows.log")
+        self.header = self._map_header()
+        self.ids, self.metadatas = [], []
+        self.positions, self.by_chat = {}, {}
+        self._changes = []  # row changes since the last save, in order
+        self._logged = 0  # row changes in rows.log
+        self._dirty = False
+        self._snapshot = False  # the next save must rewrite rows.pkl instead of appending to rows.log
+        generation = 0
+        if os.path.exists(self.rows_path):
+            with open(self.rows_path, 'rb') as f:
+                state = pickle.load(f)
+            if state["dim"] != dim:
+                raise ValueError(f"index at {path} holds {state['dim']}-dimensional vectors, not {dim}")
+            self.ids, self.metadatas, generation = state["ids"], state["metadatas"], state.get("generation", -1)
+            self.positions = {row_id: i for i, row_id in enumerate(self.ids)}
+            for row_id, metadata in zip(self.ids, self.metadatas):
+                self.by_chat.setdefault(metadata.get("chat_id"), set()).add(row_id)
+        generation = self._replay_log(generation)
+        if self.header[1] or generation != self.header[0]:
+            # Vectors changed after the rows were last written (crash before save): start over
+            self.ids, self.metadatas = [], []
+            self.positions, self.by_chat = {}, {}
+            self._dirty = self._snapshot = True
+        self.codes = self._map("vectors.i8", np.int8, (dim,))
+        self.scales = self._map("scales.f4", np.float32, ())
+        atexit.register(self.save)
+
+    def _replay_log(self, generation):
+        """Apply the logged saves that follow the snapshot's generation; returns the generation reached"""
+        if not os.path.exists(self.log_path):
+            return generation
+        with open(self.log_path, 'rb') as f:
+            while True:
+                try:
+                    logged, changes = pickle.load(f)
+                except Exception:
+                    # End of the log, or a save torn by a crash (the header is still dirty then)
+                    return generation
+                if logged <= generation:
+                    # Written before the snapshot was rewritten
+                    continue
+                if logged != generation + 1:
+                    return generation
+                for change in changes:
+                    if change[0] == "put":
+                        self._put_row(change[1], change[2])
+                    else:
+                        self._drop_row(change[1])
+                self._logged += len(changes)
+                generation = logged
+
+    def _map_header(self):
+        filename = os.path.join(self.path, "header.i8")
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                f.write(bytes(16))
+        return np.memmap(filename, dtype=np.int64, mode='r+', shape=(2,))
+
+    def _changing(self):
+        """Mark the vector files as ahead of rows.pkl before touching them"""
+        if not self._dirty:
+            self.header[1] = 1
+            self.header.flush()
+            self._dirty = True
+
+    def _map(self, name, dtype, row_shape, capacity=None):
+        filename = os.path.join(self.path, name)
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape, dtype=np.int64))
+        existing = os.path.getsize(filename) // row_bytes if os.path.exists(filename) else 0
+        capacity = max(capacity or 0, existing, len(self.ids), 1024)
+        if existing < capacity:
+            with open(filename, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        return np.memmap(filename, dtype=dtype, mode='r+', shape=(capacity,) + row_shape)
+
+    def _reserve(self, rows):
+        if rows > len(self.scales):
+            capacity = max(rows, 2 * len(self.scales))
+            self.codes.flush()
+            self.scales.flush()
+            self.codes = self._map("vectors.i8", np.int8, (self.dim,), capacity)
+            self.scales = self._map("scales.f4", np.float32, (), capacity)
+
+    def count(self):
+        return len(self.ids)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        """Insert or replace rows"""
+        codes, scales = quantize(embeddings)
+        metadatas = metadatas or [{} for _ in ids]
+        with self._lock:
+            self._changing()
+            self._reserve(len(self.ids) + len(ids))
+            positions = [self._put_row(row_id, metadata) for row_id, metadata in zip(ids, metadatas)]
+            self._changes.extend(("put", row_id, metadata) for row_id, metadata in zip(ids, metadatas))
+            self.codes[positions] = codes
+            self.scales[positions] = scales
+
+    def _put_row(self, row_id, metadata):
+        """Insert or replace a row's id and metadata; returns its position"""
+        position = self.positions.get(row_id)
+        if position is None:
+            position = self.positions[row_id] = len(self.ids)
+            self.ids.append(row_id)
+            self.metadatas.append(metadata)
+        else:
+            self.by_chat.get(self.metadatas[position].get("chat_id"), set()).discard(row_id)
+            self.metadatas[position] = metadata
+        self.by_chat.setdefault(metadata.get("chat_id"), set()).add(row_id)
+        return position
+
+    def _drop_row(self, row_id):
+        """Remove a row's id and metadata, moving the last row into its place; returns (position, last)"""
+        position = self.positions.pop(row_id)
+        self.by_chat.get(self.metadatas[position].get("chat_id"), set()).discard(row_id)
+        last = len(self.ids) - 1
+        if position != last:
+            self.ids[position] = self.ids[last]
+            self.metadatas[position] = self.metadatas[last]
+            self.positions[self.ids[position]] = position
+        self.ids.pop()
+        self.metadatas.pop()
+        return position, last
+
+    def _matching(self, ids=None, where=None):
+        if ids is not None:
+            return [row_id for row_id in ids if row_id in self.positions]
+        if where is not None:
+            if set(where) != {"chat_id"}:
+                raise ValueError("only where={'chat_id': ...} filters are supported")
+            return sorted(self.by_chat.get(where["chat_id"], ()), key=self.positions.get)
+        return list(self.ids)
+
+    def get(self, ids=None, where=None, include=("metadatas",)):
+        """{"ids": [...], "metadatas": [...]} for the given ids or chat_id filter"""
+        with self._lock:
+            matched = self._matching(ids, where)
+            return {"ids": matched, "metadatas": [self.metadatas[self.positions[row_id]] for row_id in matched]}
+
+    def delete(self, ids=None, where=None):
+        """Remove rows by id or chat_id filter"""
+        with self._lock:
+            self._changing()
+            for row_id in self._matching(ids, where):
+                position, last = self._drop_row(row_id)
+                self._changes.append(("delete", row_id))
+                if position != last:
+                    self.codes[position] = self.codes[last]
+                    self.scales[position] = self.scales[last]
+
+    def search(self, vector, n_results=10):
+        """[(position, score)] of the n_results highest dot products, best first"""
+        query = np.asarray(vector, dtype=np.float32)
+        best_positions = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        buffer = np.empty((self.TILE_ROWS, self.dim), dtype=np.float32)
+        with self._lock:
+            total = len(self.ids)
+            for start in range(0, total, self.BLOCK_ROWS):
+                end = min(start + self.BLOCK_ROWS, total)
+                scores = np.empty(end - start, dtype=np.float32)
+                for tile in range(start, end, self.TILE_ROWS):
+                    # Widen a cache-sized tile at a time so the float32 copy never leaves L2
+                    rows = min(self.TILE_ROWS, end - tile)
+                    np.copyto(buffer[:rows], self.codes[tile:tile + rows], casting='unsafe')
+                    np.matmul(buffer[:rows], query, out=scores[tile - start:tile - start + rows])
+                scores *= self.scales[start:end]
+                if len(scores) > n_results:
+                    top = np.argpartition(-scores, n_results)[:n_results]
+                else:
+                    top = np.arange(len(scores))
+                best_positions = np.concatenate([best_positions, top + start])
+                best_scores = np.concatenate([best_scores, scores[top]])
+                if len(best_scores) > n_results:
+                    keep = np.argpartition(-best_scores, n_results)[:n_results]
+                    best_positions, best_scores = best_positions[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return list(zip(best_positions[order].tolist(), best_scores[order].tolist()))
+
+    def query(self, query_embeddings, n_results=10, include=("metadatas", "distances")):
+        """ChromaDB-shaped results: {"ids": [[...]], "metadatas": [[...]], "distances": [[1 - cosine, ...]]}"""
+        results = {"ids": [], "metadatas": [], "distances": []}
+        for vector in query_embeddings:
+            with self._lock:
+                hits = self.search(vector, n_results)
+                results["ids"].append([self.ids[position] for position, _ in hits])
+                results["metadatas"].append([self.metadatas[position] for position, _ in hits])
+            results["distances"].append([1 - score for _, score in hits])
+        return results
+
+    def save(self):
+        """Flush the vector files and log the row changes since the last save (or rewrite the snapshot)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self.codes.flush()
+            self.scales.flush()
+            generation = int(self.header[0]) + 1
+            if self._snapshot or self._logged + len(self._changes) > max(len(self.ids) // 2, self.COMPACT_MIN_CHANGES):
+                atomic_write_bytes(self.rows_path, pickle.dumps(
+                    {"dim": self.dim, "generation": generation, "ids": self.ids, "metadatas": self.metadatas},
+                    protocol=pickle.HIGHEST_PROTOCOL))
+                # Logged saves now predate the snapshot; a crash before this truncation just leaves them skipped
+                open(self.log_path, 'wb').close()
+                self._logged = 0
+                self._snapshot = False
+            else:
+                with open(self.log_path, 'ab') as f:
+                    f.write(pickle.dumps((generation, self._changes), protocol=pickle.HIGHEST_PROTOCOL))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._logged += len(self._changes)
+            self._changes = []
+            self.header[:] = (generation, 0)
+            self.header.flush()
+            self._dirty = False
+
+
+def chunk_conversation(chat_id, messages, window_words=200, overlap_words=40):
+    """Split a conversation into message-level chunks with stable ids.
+
+    Messages longer than window_words are cut into overlapping word windows.
+    Ids are "<chat_id>:<message position>:<window>", so re-saving a
+    conversation reproduces the ids of every unchanged chunk.
+    """
+    chunks = []
+    step = window_words - overlap_words
+    for position, msg in enumerate(messages):
+        words = msg.get('content', '').split()
+        starts = range(0, max(1, len(words) - overlap_words), step) if len(words) > window_words else [0]
+        for window, start in enumerate(starts):
+            text = " ".join(words[start:start + window_words])
+            chunks.append({
+                "id": f"{chat_id}:{position}:{window}",
+                "text": text,
+                "metadata": {
+                    "chat_id": chat_id,
+                    "position": position,
+                    "window": window,
+                    "role": msg.get('role', ''),
+                    "content_hash": hashlib.sha1(text.encode('utf-8')).hexdigest()
+                }
+            })
+    return chunks
+
+
+class ChromaChunkStore:
+    """Batched, incremental ingestion of conversation chunks into a ChromaDB collection.
+
+    A save upserts only chunks whose id is new or whose content hash changed
+    and deletes ids the conversation no longer produces. Embeddings are
+    computed locally and sent in batches of batch_size chunks, pooled across
+    conversations when ingest() is given many at once. add/remove mirror the
+    ConversationIndex hooks, so a store can be attached to ChatHistoryManager.
+
+    known only records what the collection has confirmed: a batch leaves the
+    queue, and its hashes are recorded, once its upsert or delete succeeds, so
+    a failed flush is retried by the next one even if the text never changes.
+    One store is shared by every session of an app, so queueing, flushing and
+    deleting run under a lock.
+    """
+
+    def __init__(self, collection, embedder=None, batch_size=256, window_words=200, overlap_words=40):
+        self.collection = collection
+        self.embedder = embedder or default_embedder()
+        self.batch_size = batch_size
+        self.window_words = window_words
+        self.overlap_words = overlap_words
+        self.known = {}  # chat_id -> {chunk id: content hash} as stored in the collection
+        self._pending = {}  # chunk id -> chunk waiting to be upserted
+        self._stale = {}  # chunk id -> chat_id waiting to be deleted
+        self._lock = threading.RLock()
+
+    def _stored_hashes(self, chat_id):
+        if chat_id not in self.known:
+            stored = self.collection.get(where={"chat_id": chat_id}, include=["metadatas"])
+            self.known[chat_id] = {chunk_id: metadata.get("content_hash")
+                                   for chunk_id, metadata in zip(stored["ids"], stored["metadatas"])}
+        return self.known[chat_id]
+
+    def _queue(self, chat_id, messages, metadata=None):
+        with self._lock:
+            self._queue_locked(chat_id, messages, metadata)
+
+    def _queue_locked(self, chat_id, messages, metadata):
+        stored = self._stored_hashes(chat_id)
+        chunks = chunk_conversation(chat_id, messages, self.window_words, self.overlap_words)
+        current = set()
+        for chunk in chunks:
+            current.add(chunk["id"])
+            self._stale.pop(chunk["id"], None)
+            if stored.get(chunk["id"]) != chunk["metadata"]["content_hash"]:
+                chunk["metadata"].update(metadata or {})
+                self._pending[chunk["id"]] = chunk
+            else:
+                # Already stored as is; an older queued version must not overwrite it
+                self._pending.pop(chunk["id"], None)
+        for chunk_id in [chunk_id for chunk_id, chunk in self._pending.items()
+                         if chunk["metadata"]["chat_id"] == chat_id and chunk_id not in current]:
+            del self._pending[chunk_id]
+        self._stale.update((chunk_id, chat_id) for chunk_id in stored if chunk_id not in current)
+
+    def flush(self):
+        """Embed and upsert queued chunks in batches, then delete stale ones; returns (upserted, deleted).
+
+        A batch that raises stays queued, along with everything after it, and
+        the error propagates.
+        """
+        with self._lock:
+            return self._flush_locked()
+
+    def _flush_locked(self):
+        pending = list(self._pending.values())
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            self.collection.upsert(
+                ids=[chunk["id"] for chunk in batch],
+                embeddings=self.embedder.embed([chunk["text"] for chunk in batch]).tolist(),
+                documents=[chunk["text"] for chunk in batch],
+                metadatas=[chunk["metadata"] for chunk in batch]
+            )
+            for chunk in batch:
+                metadata = chunk["metadata"]
+                self.known.setdefault(metadata["chat_id"], {})[chunk["id"]] = metadata["content_hash"]
+                if self._pending.get(chunk["id"]) is chunk:
+                    del self._pending[chunk["id"]]
+        stale = list(self._stale.items())
+        for start in range(0, len(stale), self.batch_size):
+            batch = stale[start:start + self.batch_size]
+            self.collection.delete(ids=[chunk_id for chunk_id, _ in batch])
+            for chunk_id, chat_id in batch:
+                self.known.get(chat_id, {}).pop(chunk_id, None)
+                self._stale.pop(chunk_id, None)
+        if hasattr(self.collection, "save"):
+            # Local collections persist their id table so it never lags the vectors
+            self.collection.save()
+        return len(pending), len(stale)
+
+    def upsert_conversation(self, chat_id, messages, metadata=None):
+        """Bring one conversation's chunks up to date; returns (upserted, deleted) chunk counts"""
+        with self._lock:
+            self._queue(chat_id, messages, metadata)
+            return self.flush()
+
+    def ingest(self, conversations):
+        """Bring many (chat_id, messages) or (chat_id, messages, metadata) items up to date in pooled batches"""
+        with self._lock:
+            for item in conversations:
+                self._queue(*item)
+                if len(self._pending) >= self.batch_size:
+                    self.flush()
+            return self.flush()
+
+    def search(self, query, n_results=10, chunks_per_chat=5):
+        """[(chat_id, score, best chunk metadata)] ranked by each chat's best-matching chunk"""
+        if not self.collection.count():
+            return []
+        hits = self.collection.query(query_embeddings=self.embedder.embed([query]).tolist(),
+                                     n_results=n_results * chunks_per_chat,
+                                     include=["metadatas", "distances"])
+        best = {}
+        for metadata, distance in zip(hits["metadatas"][0], hits["distances"][0]):
+            chat_id = metadata["chat_id"]
+            if chat_id not in best:
+                best[chat_id] = (chat_id, 1 - distance, metadata)
+        return list(best.values())[:n_results]
+
+    def delete_conversation(self, chat_id):
+        """Remove every chunk of a conversation"""
+        with self._lock:
+            self.collection.delete(where={"chat_id": chat_id})
+            if hasattr(self.collection, "save"):
+                self.collection.save()
+            self.known[chat_id] = {}
+            for chunk_id in [chunk_id for chunk_id, chunk in self._pending.items()
+                             if chunk["metadata"]["chat_id"] == chat_id]:
+                del self._pending[chunk_id]
+            for chunk_id in [chunk_id for chunk_id, owner in self._stale.items() if owner == chat_id]:
+                del self._stale[chunk_id]
+
+    def add(self, chat_id, conversation):
+        self.upsert_conversation(chat_id, conversation.get('messages', []),
+                                 {"timestamp": conversation.get('timestamp', '')})
+
+    def remove(self, chat_id):
+        self.delete_conversation(chat_id)
+
+
+VECTOR_INDEXES = {
+    "semantic": SemanticIndex,
+}